@@ -2,13 +2,16 @@
 # m_plot functions for m_spec
 # Author: Martin Dubs, 2020
 # -------------------------------------------------------------------
+import glob
 import logging
 import os.path as path
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from xml.sax.saxutils import escape
 
 import PySimpleGUI as sg
 import numpy as np
-from PIL import ImageGrab
+from PIL import Image, ImageDraw, ImageFont
 
 import m_specfun as m_fun
 
@@ -34,22 +37,29 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
     """
 
     # --------------------------------------------------------------
-    def draw_spectrum(lcal, ical, lmin, lmax, color='blue'):
-        for l0 in range(0, len(lcal)):
-            if lmax > lmin:
-                if lmin <= lcal[l0] <= lmax:
-                    if l0:
-                        graph.DrawLine((lcal[l0 - 1], ical[l0 - 1]), (lcal[l0], ical[l0]), color, 2)
-            else:  # reverse axis for negative orders
-                if lmin >= lcal[l0] >= lmax:
-                    if l0:
-                        graph.DrawLine((lcal[l0 - 1], ical[l0 - 1]), (lcal[l0], ical[l0]), color, 2)
+    def set_items(key, items):
+        # scene model: key -> (primitives, figure ids), only the canvas items of key are replaced
+        if key in scene:
+            for ids in scene[key][1]:
+                for figure in ids:
+                    graph.delete_figure(figure)
+        scene[key] = (items, draw_primitives(graph, items, lmin, lmax, canvas_size[0]))
+
+    # --------------------------------------------------------------
+    def rebuild_scene():
+        # coordinates changed: axes are rebuilt, all items are drawn again in the new coordinates
+        graph.change_coordinates(*plot_coordinates(lmin, lmax, imin, imax, canvas_size))
+        graph.erase()
+        scene['axes'] = (axes_primitives(lmin, lmax, imin, imax, canvas_size, gridlines, plot_title, x_label), [])
+        for key, (items, ids) in scene.items():
+            scene[key] = (items, draw_primitives(graph, items, lmin, lmax, canvas_size[0]))
 
     # --------------------------------------------------------------
     if llist:
-        lcal, ical = np.loadtxt(llist, unpack=True, ndmin=2)
+        lcal, ical = m_fun.load_spectrum(llist)
     mod_file = ''
     caltext = ''
+    scene = {}  # axes, curves and labels with figure ids, the axes are always the first entry
     x = y = 0
     c_array = ['blue', 'green', 'red', 'black', 'grey', 'brown',
                'blue', 'green', 'red', 'black', 'grey', 'brown']
@@ -64,8 +74,7 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
         if spec_list:
             imin = 0
             imax = 0
-            for spec in spec_list:
-                lcal, ical = np.loadtxt(spec, unpack=True, ndmin=2)
+            for spec, (lcal, ical) in zip(spec_list, m_fun.load_spectra(spec_list)):
                 ical = ical + index * offset
                 imin = min(imin, min(ical))
                 imax = max(imax, max(ical))
@@ -84,17 +93,15 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
         idelta = 0.05 * (imax - imin)
         imin -= idelta
         imax += idelta
-    points = []
-    for l0 in range(len(lcal) - 1):
-        points.append((lcal[l0], ical[l0]))
     # y coordinate autoscale
     # plotscale pixel/unit
     lscale = canvas_size[0] / (lmax - lmin)
     iscale = canvas_size[1] / (imax - imin)
     # layout with border for scales, legends
+    bottom_left, top_right = plot_coordinates(lmin, lmax, imin, imax, canvas_size)
     layout = [[sg.Graph(canvas_size=canvas_size,
-                        graph_bottom_left=(lmin - 40 / lscale, imin - 40 / iscale),
-                        graph_top_right=(lmax + 10 / lscale, imax + 30 / iscale),
+                        graph_bottom_left=bottom_left,
+                        graph_top_right=top_right,
                         enable_events=True, float_values=True, background_color='white', key='graph')],
               [sg.Button('Save', key='Save', bind_return_key=True), sg.Button('Close Window', key='Close'),
                sg.Text('Imin:'), sg.InputText('', key='imin', size=(8, 1)),
@@ -105,56 +112,23 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
 
     right_click_menu = ['unused', ['Multiply spectrum by factor', 'Divide Spectrum by factor',
                                    'Save modified spectrum', 'Normalize to peak value',
-                                   'Compare with spectrum', 'Label Peak']]
+                                   'Compare with spectrum', 'Label Peak', 'Auto Label Peaks']]
 
     window = sg.Window(llist, layout, keep_on_top=True, right_click_menu=right_click_menu,
                        grab_anywhere=True).Finalize()
     graph = window['graph']
-    label_str, lam_calib = m_fun.create_line_list_combo('m_linelist', window, combo=False)
+    try:
+        catalog = m_fun.line_catalog('m_linelist')
+    except FileNotFoundError:
+        catalog = m_fun.line_catalog([])
 
-    # draw x-axis
+    # draw axes, grid and labels, the same primitives are used by render_plot
     if lcal[0]:  # for raw spectrum lcal[0] = 0, otherwise lmin
         x_label = u'\u03BB' + ' [nm]'
     else:
         x_label = 'Pixel'
-    # lamda = u'\u03BB'
-    graph.DrawText(x_label, ((lmax + lmin) / 2, imin - 30 / iscale), font='Arial 12')
-    graph.DrawText(plot_title, ((lmax + lmin) / 2, imax + 15 / iscale), font='Arial 12')
-    # calculate spacing
-    deltax = round((lmax - lmin) / 250) * 50
-    const = 1
-    while not deltax:
-        const *= 10
-        deltax = int(const * (lmax - lmin) / 250) * 50
-    deltax /= const
-    dmax = int(lmax / deltax) + 1
-    dmin = int(lmin / deltax)
-    for x in range(dmin, dmax):
-        graph.DrawLine((x * deltax, imin - 3 / iscale), (x * deltax, imin))
-        if gridlines:
-            graph.DrawLine((x * deltax, imin), (x * deltax, imax), 'grey')
-        graph.DrawText(x * deltax, (x * deltax, imin - 5 / iscale), text_location=sg.TEXT_LOCATION_TOP, font='Arial 10')
-
-    # draw y-axis
-    graph.DrawText('I', (lmin - 30 / lscale, (imin + imax) / 2), font='Arial 12')
-    # calculate spacing
-    deltay = round((imax - imin) / 5)
-    const = 1
-    while not deltay:
-        const *= 10
-        deltay = int(const * (imax - imin) / 5)
-    deltay /= const
-    dmax = int(imax / deltay) + 1
-    dmin = int(imin / deltay)
-    for d in range(dmin, dmax):
-        graph.DrawLine((lmin - 3 / lscale, d * deltay), (lmin, d * deltay))
-        if gridlines:
-            graph.DrawLine((lmin, d * deltay), (lmax, d * deltay), 'grey')
-        graph.DrawText(d * deltay, (lmin - 5 / lscale, d * deltay), text_location=sg.TEXT_LOCATION_RIGHT,
-                       font='Arial 10')
-
-    graph.DrawRectangle((lmin, imin), (lmax, imax), line_width=2)
-    # draw graph
+    set_items('axes', axes_primitives(lmin, lmax, imin, imax, canvas_size, gridlines, plot_title, x_label))
+    # draw graph, lmin > lmax: reverse axis for negative orders
     if multi_plot:
         if index:
             for ind in range(index):
@@ -162,11 +136,11 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
                     pos_y = 25 * (ind + 1)
                 else:
                     pos_y = 25 * (index - ind)
-                draw_spectrum(l_array[ind], i_array[ind], lmin, lmax, color=c_array[ind])
-                graph.DrawText(f_array[ind], (lmax - 20 / lscale, imax - pos_y / iscale),
-                   text_location=sg.TEXT_LOCATION_RIGHT, font='Arial 12', color=c_array[ind])
+                set_items(f'spectrum{ind}', [('curve', l_array[ind], i_array[ind], c_array[ind], 2),
+                                             ('text', f_array[ind], (lmax - 20 / lscale, imax - pos_y / iscale),
+                                              'rm', 12, c_array[ind])])
     else:
-        draw_spectrum(lcal, ical, lmin, lmax)
+        set_items('spectrum', [('curve', lcal, ical, 'blue', 2)])
     while True:
         event, values = window.read()
         if event in (None, 'Close'):
@@ -179,18 +153,18 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
 
         elif event is 'Save':
             window.Minimize()
-            filename = sg.popup_get_file('Choose filename (PNG) to save to', save_as=True, keep_on_top=True,
+            filename = sg.popup_get_file('Choose filename (PNG or SVG) to save to', save_as=True, keep_on_top=True,
                             no_window=True, default_path=llist, default_extension='.png', size=(80, 1))
             window.Normal()
-            time.sleep(1.0)
             if filename:
                 p, ext = path.splitext(filename)
-                p += '.png'
+                p += '.svg' if ext.lower() == '.svg' else '.png'
             else:
                 # p = str(Path(llist).with_suffix('')) + '_plot.png'
                 p, ext = path.splitext(llist)
                 p += '_plot.png'
-            save_element_as_file(window['graph'], p)
+            render_plot(p, [item for items, ids in scene.values() for item in items],
+                        lmin, lmax, imin, imax, canvas_size)
             info = f'spectrum {llist} plot saved as {str(p)}'
             logging.info(info)
             caltext += info + '\n'
@@ -201,9 +175,7 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
                 imin = float(values['imin'])
                 imax = float(values['imax'])
                 iscale = canvas_size[1] / (imax - imin)
-                graph.change_coordinates((lmin - 40 / lscale, imin - 40 / iscale),
-                                         (lmax + 10 / lscale, imax + 30 / iscale))
-                draw_spectrum(lcal, ical, lmin, lmax, color='red')
+                rebuild_scene()
                 graph.update()
             except:
                 sg.PopupError('invalid values for Imin, Imax, try again', keep_on_top=True)
@@ -217,7 +189,7 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
                 info = f'spectrum {llist} divided by factor {factor}'
             caltext += info + '\n'
             logging.info(info)
-            draw_spectrum(lcal, ical, lmin, lmax, color='red')
+            set_items('spectrum', [('curve', lcal, ical, 'red', 2)])
             graph.update()
         elif event is 'Save modified spectrum':
             window.Minimize()
@@ -242,7 +214,9 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
                    f'saved as {mod_file}'
             caltext += info
             logging.info(info)
-            draw_spectrum(lcal, ical, lmin, lmax, color='red')
+            iscale = canvas_size[1] / (imax - imin)
+            scene['spectrum'] = ([('curve', lcal, ical, 'red', 2)], [])
+            rebuild_scene()
         elif event is 'Compare with spectrum':
             window.Minimize()
             comp_file = sg.PopupGetFile('Compare with spectrum', save_as=False, no_window=True,
@@ -251,41 +225,33 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
             if comp_file:
                 window.Normal()
                 caltext += f'File {comp_file} loaded\n'
-                lcomp, icomp = np.loadtxt(comp_file, unpack=True, ndmin=2)
-                draw_spectrum(lcomp, icomp, lmin, lmax, color='red')
-                graph.DrawText(llist, (lmax - 20 / lscale, imax - 15 / iscale),
-                               text_location=sg.TEXT_LOCATION_RIGHT,
-                               font='Arial 12', color='blue')
-                graph.DrawText(comp_file, (lmax - 20 / lscale, imax - 40 / iscale),
-                               text_location=sg.TEXT_LOCATION_RIGHT,
-                               font='Arial 12', color='red')
+                lcomp, icomp = m_fun.load_spectrum(comp_file)
+                set_items('compare', [('curve', lcomp, icomp, 'red', 2),
+                                      ('text', llist, (lmax - 20 / lscale, imax - 15 / iscale), 'rm', 12, 'blue'),
+                                      ('text', comp_file, (lmax - 20 / lscale, imax - 40 / iscale), 'rm', 12,
+                                       'red')])
         elif event is 'Label Peak':
             layout_label = [[sg.InputText('Cursor', size=(40, 1), key='cursor', disabled=True)],
                             [sg.InputText('', size=(40, 1), key='label')],
                             [sg.Button('Apply'), sg.Button('Cancel')]]
             window_label = sg.Window('Label Peak', layout_label, keep_on_top=True).Finalize()
-            for k in range(len(lam_calib)):
-                if label_str[k][0] < x:
-                    kk = k
-            if kk < len(lam_calib):
-                if abs(label_str[kk][0] - x) > abs(label_str[kk + 1][0] - x):
-                    kk += 1
-            window_label['label'].update(lam_calib[kk])
-            klam = 0
-            for k in range(len(lcal)):
-                if lcal[k] < x:
-                    klam = k
-            i_peak = 0
-            for k in range(max(0, klam - 10), min(klam + 10, len(lcal))):
-                i_peak = max(i_peak, ical[k])
-                lam_peak = label_str[kk][0]
+            if len(catalog['lam']):
+                kk = int(m_fun.nearest_lines(catalog, x))
+                label = catalog['text'][kk]
+                lam_peak = catalog['lam'][kk]
+            else:
+                label = f'{x:.1f} '
+                lam_peak = x
+            window_label['label'].update(label)
+            klam = int(np.argmin(np.abs(lcal - x)))
+            i_peak = max(0, np.max(ical[max(0, klam - 10):klam + 10]))
             window_label['cursor'].update(f'Lambda:{lcal[klam]:8.2f}  Peak:{i_peak:8.2f}')
             while True:
                 event, values = window_label.read()
                 if event in 'Apply':
                     # check if label changed
                     new_label = values['label']
-                    if new_label != lam_calib[kk]:
+                    if new_label != label:
                         x = new_label.lstrip()
                         if len(x.split(' ', 1)) == 2:
                             (lam_peak, name) = x.split(' ', 1)
@@ -297,49 +263,382 @@ def graph_calibrated_spectrum(llist, lmin=0, lmax=720, imin=0, imax=1, autoscale
                             break
                         lam_peak = float(lam_peak)
                     if y > i_peak:
-                        graph.DrawLine((lam_peak, i_peak + 20 / iscale), (lam_peak, y - 20 / iscale), 'black', 2)
+                        marker = [(lam_peak, i_peak + 20 / iscale), (lam_peak, y - 20 / iscale)]
                     else:
-                        graph.DrawLine((lam_peak, i_peak - 20 / iscale), (lam_peak, y + 20 / iscale), 'black', 2)
-                    graph.DrawText(new_label, location=(lam_peak, y),
-                                   text_location=sg.TEXT_LOCATION_CENTER,
-                                   font='Arial 12', color='black')
+                        marker = [(lam_peak, i_peak - 20 / iscale), (lam_peak, y + 20 / iscale)]
+                    set_items(f'label{len(scene)}', [('line', marker, 'black', 2),
+                                                     ('text', new_label, (lam_peak, y), 'mm', 12, 'black')])
                 if event in ('Cancel', None):
                     pass
                 window_label.close()
                 break
+        elif event == 'Auto Label Peaks':
+            snr = sg.PopupGetText('label all peaks with signal to noise ratio above:', title='Auto Label Peaks',
+                                  default_text='10', keep_on_top=True)
+            if snr:
+                try:
+                    set_items('autolabel', peak_label_primitives(lcal, ical, catalog, float(snr), iscale))
+                except ValueError:
+                    sg.PopupError('invalid value for signal to noise ratio', keep_on_top=True)
+
+
+# -------------------------------------------------------------------
+
+def peak_label_primitives(lcal, ical, catalog, snr=10.0, iscale=1.0, max_peaks=50):
+    """
+    labels for all peaks above a threshold in one pass, each peak is labelled with the closest
+    catalogue line if it is within the peak width, otherwise with its wavelength
+    :param lcal, ical: spectrum
+    :param catalog: line catalogue, see m_specfun.line_catalog
+    :param snr: minimum signal to noise ratio of labelled peaks
+    :param iscale: plot scale [pixel / intensity unit] for the label offset
+    :param max_peaks: maximum number of labels
+    :return: list of primitives, see axes_primitives
+    """
+    index = np.arange(len(lcal))
+    xp, height, fwhm, peak_snr = m_fun.find_spectral_peaks(index, ical, snr=snr, max_peaks=max_peaks)
+    lam_peak = np.interp(xp, index, lcal)
+    i_peak = np.interp(xp, index, ical)
+    tolerance = np.maximum(np.nan_to_num(fwhm), 2) * np.abs(np.gradient(lcal))[np.round(xp).astype(int)]
+    kk = m_fun.nearest_lines(catalog, lam_peak)
+    items = []
+    for lp, ip, k, tol in zip(lam_peak, i_peak, kk, tolerance):
+        if len(catalog['lam']) and abs(catalog['lam'][k] - lp) < tol:
+            label = catalog['text'][k]
+        else:
+            label = f'{lp:.1f}'
+        items.append(('line', [(lp, ip + 5 / iscale), (lp, ip + 20 / iscale)], 'black', 1))
+        items.append(('text', label, (lp, ip + 30 / iscale), 'mm', 10, 'black'))
+    return items
+
+
+# -------------------------------------------------------------------
+
+def plot_coordinates(lmin, lmax, imin, imax, canvas_size):
+    """
+    coordinates of the plot canvas with border for scales and legends
+    :param lmin, lmax: wavelength range, can be inverse
+    :param imin, imax: intensity range
+    :param canvas_size: size of canvas in pixel
+    :return: bottom_left, top_right: canvas corners in data coordinates
+    """
+    lscale = canvas_size[0] / (lmax - lmin)
+    iscale = canvas_size[1] / (imax - imin)
+    return (lmin - 40 / lscale, imin - 40 / iscale), (lmax + 10 / lscale, imax + 30 / iscale)
 
 
 # -------------------------------------------------------------------
 
-def save_element_as_file(element, filename):
+def _tick_spacing(vmin, vmax, divisor, step=1):
     """
-    Saves any element as an image file.
-    Element needs to have an underlying Widget available (almost if not all of them do)
-    : param element: The element to save
-    : param filename: The filename to save to. The extension of the filename determines the format (jpg, png, gif, ?)
+    spacing of axis ticks, about (vmax - vmin) / divisor rounded to step,
+    step for an empty or invalid range
     """
-    widget = element.Widget
-    box = (widget.winfo_rootx(), widget.winfo_rooty(), widget.winfo_rootx() + widget.winfo_width(),
-           widget.winfo_rooty() + widget.winfo_height())
-    grab = ImageGrab.grab(bbox=box)
-    grab.save(filename)
+    if not np.isfinite(vmax - vmin) or vmax == vmin:
+        return step
+    delta = round((vmax - vmin) / divisor) * step
+    const = 1
+    while not delta:
+        const *= 10
+        delta = int(const * (vmax - vmin) / divisor) * step
+    return delta / const
 
 
 # -------------------------------------------------------------------
 
+def axes_primitives(lmin, lmax, imin, imax, canvas_size=(800, 400), gridlines=True, plot_title='Spectrum',
+                    x_label='Pixel'):
+    """
+    axes, grid, tick labels and titles of a spectrum plot as a list of drawing primitives
+    in data coordinates, drawn by draw_primitives (screen) or render_plot (file):
+    ('line', points, color, width), ('text', text, location, anchor, fontsize, color),
+    ('rect', bottom_left, top_right, width), ('curve', x, y, color, width)
+    anchor: 'mm' center, 'mt' top, 'rm' right
+    :param lmin, lmax: wavelength range, can be inverse
+    :param imin, imax: intensity range
+    :param canvas_size: size of canvas in pixel
+    :param gridlines: if True, grid lines are drawn
+    :param plot_title: title displayed at the top
+    :param x_label: label of x-axis
+    :return: list of primitives
+    """
+    lscale = canvas_size[0] / (lmax - lmin)
+    iscale = canvas_size[1] / (imax - imin)
+    items = [('text', x_label, ((lmax + lmin) / 2, imin - 30 / iscale), 'mm', 12, 'black'),
+             ('text', plot_title, ((lmax + lmin) / 2, imax + 15 / iscale), 'mm', 12, 'black')]
+    deltax = _tick_spacing(lmin, lmax, 250, 50)
+    for d in range(int(lmin / deltax), int(lmax / deltax) + 1):
+        items.append(('line', [(d * deltax, imin - 3 / iscale), (d * deltax, imin)], 'black', 1))
+        if gridlines:
+            items.append(('line', [(d * deltax, imin), (d * deltax, imax)], 'grey', 1))
+        items.append(('text', round(d * deltax, 6), (d * deltax, imin - 5 / iscale), 'mt', 10, 'black'))
+    items.append(('text', 'I', (lmin - 30 / lscale, (imin + imax) / 2), 'mm', 12, 'black'))
+    deltay = _tick_spacing(imin, imax, 5)
+    for d in range(int(imin / deltay), int(imax / deltay) + 1):
+        items.append(('line', [(lmin - 3 / lscale, d * deltay), (lmin, d * deltay)], 'black', 1))
+        if gridlines:
+            items.append(('line', [(lmin, d * deltay), (lmax, d * deltay)], 'grey', 1))
+        items.append(('text', round(d * deltay, 6), (lmin - 5 / lscale, d * deltay), 'rm', 10, 'black'))
+    items.append(('rect', (lmin, imin), (lmax, imax), 2))
+    return items
+
+
+# -------------------------------------------------------------------
+
+def draw_primitives(graph, items, lmin=0, lmax=0, columns=0):
+    """
+    draws primitives (see axes_primitives) in a sg.Graph
+    :param graph: sg.Graph element
+    :param items: list of primitives
+    :param lmin, lmax: x-range for curves
+    :param columns: width of canvas for decimation of curves, see draw_polyline
+    :return: list of figure ids for each item
+    """
+    location = {'mm': sg.TEXT_LOCATION_CENTER, 'mt': sg.TEXT_LOCATION_TOP, 'rm': sg.TEXT_LOCATION_RIGHT}
+    ids = []
+    for item in items:
+        if item[0] == 'line':
+            ids.append([graph.DrawLines(item[1], item[2], item[3])])
+        elif item[0] == 'text':
+            ids.append([graph.DrawText(item[1], item[2], color=item[5], font=f'Arial {item[4]}',
+                                       text_location=location[item[3]])])
+        elif item[0] == 'rect':
+            ids.append([graph.DrawRectangle(item[1], item[2], line_width=item[3])])
+        elif item[0] == 'curve':
+            ids.append(draw_polyline(graph, item[1], item[2], lmin, lmax, item[3], item[4], columns))
+    return ids
+
+
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=8)
+def _pil_font(size):
+    """
+    Arial or a similar font for offscreen rendering, cached for each size
+    """
+    for name in ('arial.ttf', 'Arial.ttf', 'DejaVuSans.ttf', 'LiberationSans-Regular.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            pass
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
+
+
+# -------------------------------------------------------------------
+
+def render_plot(filename, items, lmin, lmax, imin, imax, canvas_size=(800, 400), scale=1):
+    """
+    renders a plot offscreen, without window and screen grabbing, as PIL image or SVG file
+    :param filename: output file, extension .svg: vector file, otherwise image (png, jpg, ...)
+    :param items: primitives of plot, see axes_primitives
+    :param lmin, lmax: wavelength range, can be inverse
+    :param imin, imax: intensity range
+    :param canvas_size: size of plot in pixel at scale 1, same as in graph_calibrated_spectrum
+    :param scale: resolution factor, e.g. 2 for print
+    :return: filename
+    """
+    (x0, y0), (x1, y1) = plot_coordinates(lmin, lmax, imin, imax, canvas_size)
+    width = int(canvas_size[0] * scale)
+    height = int(canvas_size[1] * scale)
+
+    def xy(points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return np.column_stack([(points[:, 0] - x0) / (x1 - x0) * width,
+                                (1 - (points[:, 1] - y0) / (y1 - y0)) * height])
+
+    svg = path.splitext(filename)[1].lower() == '.svg'
+    if svg:
+        anchor = {'mm': ('middle', 'central'), 'mt': ('middle', 'hanging'), 'rm': ('end', 'central')}
+        lines = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">',
+                 f'<rect width="{width}" height="{height}" fill="white"/>']
+    else:
+        image = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(image)
+    for item in items:
+        if item[0] == 'curve':
+            polylines = [np.column_stack(xys) for xys in curve_sections(item[1], item[2], lmin, lmax,
+                                                                        width)]
+            color, line_width = item[3], item[4]
+        elif item[0] == 'line':
+            polylines = [item[1]]
+            color, line_width = item[2], item[3]
+        elif item[0] == 'rect':
+            (a, b), (c, d) = item[1], item[2]
+            polylines = [[(a, b), (c, b), (c, d), (a, d), (a, b)]]
+            color, line_width = 'black', item[3]
+        else:
+            text, location, anch, size, color = item[1:]
+            (tx, ty), = xy(location)
+            size = int(round(size * 4 / 3 * scale))  # pt to pixel
+            if svg:
+                lines.append(f'<text x="{tx:.1f}" y="{ty:.1f}" font-family="Arial" font-size="{size}" '
+                             f'fill="{color}" text-anchor="{anchor[anch][0]}" '
+                             f'dominant-baseline="{anchor[anch][1]}">{escape(str(text))}</text>')
+            else:
+                draw.text((tx, ty), str(text), fill=color, font=_pil_font(size), anchor=anch)
+            continue
+        for polyline in polylines:
+            p = xy(polyline)
+            if svg:
+                coords = ' '.join(f'{px:.2f},{py:.2f}' for px, py in p)
+                lines.append(f'<polyline points="{coords}" fill="none" stroke="{color}" '
+                             f'stroke-width="{line_width * scale}"/>')
+            else:
+                draw.line([tuple(q) for q in p], fill=color, width=max(1, int(round(line_width * scale))),
+                          joint='curve')
+    if svg:
+        lines.append('</svg>')
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+    else:
+        image.save(filename)
+    return filename
+
+
+# -------------------------------------------------------------------
+
+def plot_spectra(spec_files, ext='.png', canvas_size=(800, 400), gridlines=True, scale=1):
+    """
+    plots spectra into files without GUI, e.g. for all spectra of a night
+    the axes are scaled automatically as in graph_calibrated_spectrum,
+    a flat spectrum is plotted with a range of +-10% (at least 1) around its value,
+    files which cannot be read or plotted are logged and skipped
+    :param spec_files: list of spectra (.dat) or glob pattern, e.g. 'out/*cal2.dat'
+    :param ext: '.png', '.svg' or other image format
+    :param canvas_size: size of plot in pixel at scale 1
+    :param gridlines: if True, grid lines are drawn
+    :param scale: resolution factor
+    :return: list of plot files, spectrum + '_plot' + ext
+    """
+    if isinstance(spec_files, str):
+        spec_files = sorted(glob.glob(spec_files))
+    plots = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # spectra read in parallel as in m_fun.load_spectra, errors reported for each file
+        futures = [executor.submit(m_fun.load_spectrum, spec) for spec in spec_files]
+        for spec, future in zip(spec_files, futures):
+            try:
+                (lcal, ical) = future.result()
+                lmin = lcal[0]
+                lmax = lcal[len(lcal) - 1]
+                if lmax == lmin:
+                    (lmin, lmax) = (lmin - 1, lmax + 1)
+                idelta = 0.05 * (max(ical) - min(ical))
+                if not idelta > 0:
+                    idelta = max(0.1 * abs(ical[0]), 1)  # flat spectrum
+                imin = min(ical) - idelta
+                imax = max(ical) + idelta
+                x_label = u'\u03BB' + ' [nm]' if lcal[0] else 'Pixel'
+                items = axes_primitives(lmin, lmax, imin, imax, canvas_size, gridlines, spec, x_label)
+                items.append(('curve', lcal, ical, 'blue', 2))
+                plots.append(render_plot(m_fun.change_extension(spec, '_plot' + ext), items, lmin, lmax, imin,
+                                         imax, canvas_size, scale))
+            except (OSError, ValueError, IndexError) as e:
+                logging.info(f'{spec} not plotted: {e}')
+    logging.info(f'{len(plots)} of {len(spec_files)} spectra plotted')
+    return plots
+
+
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=32)
+def _lod_indices(x_bytes, y_bytes, lo, hi, columns):
+    """
+    indices of the samples kept by decimate_minmax, cached for each curve, x-range and canvas width
+    """
+    x = np.frombuffer(x_bytes)
+    y = np.frombuffer(y_bytes)
+    n = len(x)
+    bucket = np.clip(((x - lo) / (hi - lo) * columns).astype(int), 0, columns - 1)
+    order = np.lexsort((y, bucket))  # sorted by bucket, in each bucket by intensity
+    b = bucket[order]
+    first = np.flatnonzero(np.concatenate([[True], b[1:] != b[:-1]]))
+    last = np.concatenate([first[1:] - 1, [n - 1]])
+    keep = np.unique(np.concatenate([order[first], order[last], [0, n - 1]]))
+    keep.flags.writeable = False
+    return keep
+
+
+# -------------------------------------------------------------------
+
+def decimate_minmax(x, y, lmin, lmax, columns):
+    """
+    level of detail for plotting: reduces a curve to the minimum and maximum in each
+    canvas column (about 2 points per column), so peaks are preserved
+    the result is cached and recomputed only if the curve, the x-range or the canvas width change
+    :param x, y: coordinates of curve
+    :param lmin, lmax: x-range of plot, can be inverse
+    :param columns: width of canvas in pixel
+    :return: x, y of decimated curve, unchanged if not longer than 2 * columns
+    """
+    x = np.ascontiguousarray(x, dtype=float)
+    y = np.ascontiguousarray(y, dtype=float)
+    if len(x) <= 2 * columns or lmin == lmax:
+        return x, y
+    keep = _lod_indices(x.tobytes(), y.tobytes(), float(min(lmin, lmax)), float(max(lmin, lmax)), int(columns))
+    return x[keep], y[keep]
+
+
+# -------------------------------------------------------------------
+
+def draw_polyline(graph, x, y, lmin, lmax, color='blue', width=1, columns=0):
+    """
+    draws a curve as one canvas item instead of a line for each pair of samples
+    a segment is drawn if its end point is inside the range lmin, lmax (vectorized mask),
+    each contiguous section of segments is drawn as one polyline
+    :param graph: sg.Graph element
+    :param x, y: coordinates of curve
+    :param lmin, lmax: x-range, can be inverse
+    :param color: line color
+    :param width: line width
+    :param columns: width of canvas in pixel for min/max decimation, 0: all samples are drawn
+    :return: list of figure ids, one for each section
+    """
+    return [graph.DrawLines(list(zip(xs, ys)), color, width)
+            for xs, ys in curve_sections(x, y, lmin, lmax, columns)]
+
+
+# -------------------------------------------------------------------
+
+def curve_sections(x, y, lmin, lmax, columns=0):
+    """
+    contiguous sections of a curve inside the range lmin, lmax, see draw_polyline
+    :param x, y: coordinates of curve
+    :param lmin, lmax: x-range, can be inverse
+    :param columns: width of canvas in pixel for min/max decimation, 0: all samples are kept
+    :return: list of (xs, ys) for each section
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    inside = (x >= min(lmin, lmax)) & (x <= max(lmin, lmax))
+    edges = np.diff(np.concatenate([[0], inside[1:].astype(int), [0]]))
+    sections = []
+    for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        xs = x[start:end + 1]
+        ys = y[start:end + 1]
+        if columns:
+            xs, ys = decimate_minmax(xs, ys, lmin, lmax, columns)
+        sections.append((xs, ys))
+    return sections
+
+
+# -------------------------------------------------------------------
 
 def plot_raw_spectrum(rawspec, graph, canvasx):
     """
     plots  a raw (uncalibrated)spectrum for selection of calibration lines
     :param rawspec: filename of uncalibrated spectrum with extension .dat
     :param graph: window to display spectrum
-    :param canvasx: width of graph (needed to size points in graph)
+    :param canvasx: width of graph (needed for decimation of long spectra)
     :return:
     lmin, lmax: pixel range
     imin, imax: intensity range
     lcal, ical: pixel, intensity array
     """
-    lcal, ical = np.loadtxt(rawspec, unpack=True, ndmin=2)
+    lcal, ical = m_fun.load_spectrum(rawspec)
     lmin = lcal[0]
     lmax = lcal[len(lcal) - 1]
     # y coordinate autoscale
@@ -348,20 +647,14 @@ def plot_raw_spectrum(rawspec, graph, canvasx):
     idelta = 0.05 * (imax - imin)
     imin -= idelta
     imax += idelta
-    points = []
-    for l0 in range(len(lcal)):
-        points.append((lcal[l0], ical[l0]))
     # graph = window['graph']
     graph.change_coordinates((lmin, imin), (lmax, imax))
-    # erase graph with rectangle
+    # erase graph, remove items of previous spectrum
+    graph.erase()
     graph.DrawRectangle((lmin, imin), (lmax, imax), fill_color='white', line_width=1)
     graph.DrawText(rawspec, (0.5 * (lmax - lmin), imax - 0.05 * (imax - imin)))
     # draw graph
-    for l0 in range(0, len(lcal)):
-        if lmin <= lcal[l0] < lmax:
-            graph.DrawCircle(points[l0], 2 / canvasx, line_color='red', fill_color='red')
-            if l0:
-                graph.DrawLine(points[l0 - 1], points[l0], 'red', 1)
+    draw_polyline(graph, lcal, ical, lmin, lmax, 'red', 1, columns=int(canvasx))
     return lmin, lmax, imin, imax, lcal, ical
 
 # -------------------------------------------------------------------
@@ -214,6 +214,38 @@ def main():
                     sg.InputText(str(nm), size=(18, 1), key='-N_REG-',
                                 tooltip='Limit number of images to register, \n' +
                                 'if register fails, limit is set automatically')],
+                    [sg.Text('Method:'),
+                    sg.Combo(['gauss', 'fft'], default_value='gauss', size=(8, 1), key='-REG_METHOD-', readonly=True,
+                             tooltip='gauss: 2-D Gaussian fit of selected line\n' +
+                             'fft: phase correlation of selected rectangle, for faint or saturated lines'),
+                    sg.Checkbox('stack reference', default=False, key='-REG_STACK-',
+                                tooltip='fft: correlate with sum of registered images instead of start image')],
+                    [sg.Checkbox('multiple lines', default=False, key='-REG_MULTI-',
+                                 tooltip='select rectangles around two or more lines (or zero order),\n' +
+                                 'registration corrects rotation and scale of the spectrum')],
+                    [sg.Text('Predict:'),
+                    sg.Combo(['off', 'velocity', 'acceleration'], default_value='off', size=(11, 1),
+                             key='-REG_PREDICT-', readonly=True,
+                             tooltip='motion model for the position of the line in the next image,\n' +
+                             'for fast or accelerating meteors'),
+                    sg.Text('Processes:'),
+                    sg.InputText(str(min(os.cpu_count() or 1, 2)), size=(4, 1), key='-WORKERS-',
+                                 tooltip='number of parallel processes for shifting and adding images')],
+                    [sg.Text('Stack:'),
+                    sg.Combo(['mean', 'median', 'clip', 'snr'], default_value='mean', size=(8, 1),
+                             key='-REG_COMBINE-', readonly=True,
+                             tooltip='mean: average, median: median of registered images,\n' +
+                             'clip: sigma clipped average, rejects hot pixels and aircraft,\n' +
+                             'snr: average weighted with peak of registered line'),
+                    sg.Text('Write every:'),
+                    sg.InputText('1', size=(4, 1), key='-REG_WRITE-',
+                                 tooltip='save every Kth registered image,\n' +
+                                 '0: save only sum image and shift table')],
+                    [sg.Text('Exclude:'),
+                    sg.InputText('', size=(18, 1), key='-REG_EXCL-',
+                                 tooltip='images not added, e.g. 3, 7-9'),
+                    sg.Button('Restack', key='-RESTACK-',
+                              tooltip='add images with saved shifts for changed start, number or excluded images')],
                     [sg.Text('_' * 44)],
                     [sg.Button('Sel Start', key='-SEL_START-', tooltip='set actual image as start image'),
                     sg.Button('Sel Last', key='-SEL_LAST-', tooltip='set actual image as last image')],
@@ -224,7 +256,9 @@ def main():
                     sg.Button('Load Radd', key='-LOAD_R-', tooltip='Load file for spectrum extraction')],
                     [sg.Button('Add Rows', disabled=True, key='-ADD_ROWS-'),
                     sg.Button('Save raw spectrum', disabled=True, key='-SAVE_RAW-'),
-                    sg.Button('Calibrate', disabled=True, key='-CAL_R-', tooltip='Continue with calibration')],
+                    sg.Button('Calibrate', disabled=True, key='-CAL_R-', tooltip='Continue with calibration'),
+                    sg.Button('Cube', disabled=True, key='-CUBE-',
+                              tooltip='spectrum of each registered image and light curves of lines')],
                     [sg.Text('Results')],
                     [sg.Multiline('Result', size=(42, 15), disabled=True, key='-RESULT3-',
                                     autoscroll=True)]]), image_element_registration]]
@@ -258,7 +292,9 @@ def main():
         [sg.InputText(outfile, size=(31, 1), key='-SPEC_R-'),
          sg.Button('Load Raw', key='-LOAD_RAW-')],
         [sg.Button('Select Lines', key='-S_LINES-', disabled=True, button_color=bc_disabled,
-                   tooltip='Click to start new calibration, finish with "Save table"')],
+                   tooltip='Click to start new calibration, finish with "Save table"'),
+         sg.Button('Auto Lines', key='-AUTO_L-', disabled=True, button_color=bc_disabled,
+                   tooltip='Identify calibration lines automatically, uses D_DISP0 as start value')],
         [sg.Text('Pos          Wavelength')],
         [sg.InputText('0', size=(9, 1), justification='r', key='-POS-', disabled=True),
          sg.Combo(['           ', '0 zero', '517.5 Mg I', '589 Na I', '777.4 O I'], key='-LAMBDA-',
@@ -270,7 +306,15 @@ def main():
          sg.Button('Calibration', key='-CALI-', disabled=True, button_color=bc_disabled),
          sg.Text('Polynomial degree:'),
          sg.Combo([0, 1, 2, 3, 4, 5], key='-POLY-', enable_events=True, default_value=1,
-                  tooltip='for single line calibration select 0, otherwise selct degree of polynomial')],
+                  tooltip='for single line calibration select 0, otherwise selct degree of polynomial'),
+         sg.Button('Batch', key='-BATCH_C-',
+                   tooltip='Apply saved wavelength solution (*cal.ini) to several raw spectra or cubes')],
+        [sg.Checkbox('flux conserving', default=False, key='-FLUX-',
+                     tooltip='rebin cal2.dat and cubes conserving the line flux, else quadratic interpolation'),
+         sg.Checkbox('response', default=False, key='-RESP-',
+                     tooltip='correct instrument response, stored for INSTRUME and TELESCOP'),
+         sg.Button('Response', key='-RESP_B-',
+                   tooltip='Build instrument response from calibrated spectrum of star or lamp')],
         plot_elem,
         [sg.Multiline('Result', size=(40, 15), disabled=True, key='-RESULT4-', autoscroll=True)]]),
                    sg.Frame('Raw spectrum', column, key='-COLUMN-')]]
@@ -761,55 +805,127 @@ def main():
         # Registration Tab
         # ==============================================================================
         elif event is '-REGISTER-':
-            window['-SHOW_SUM_R-'].update(disabled=True, button_color=bc_disabled)
-            window['-CAL_R-'].update(disabled=True, button_color=bc_disabled)
+            # numeric fields are checked before the rectangle is selected
+            try:
+                start = int(values['-N_START_R-'])
+                nim = int(values['-N_REG-'])
+                nmp = int(values['-N_MAX_R-'])
+                write_every = int(values['-REG_WRITE-'])
+                reg_exclude = m_fun.parse_index_list(values['-REG_EXCL-'])
+                reg_valid = write_every >= 0
+            except ValueError:
+                reg_valid = False
+            try:
+                workers = min(max(int(values['-WORKERS-']), 1), os.cpu_count() or 1)
+            except ValueError:
+                workers = 1
+            if not reg_valid:
+                sg.PopupError('invalid input, use integers for the images, 0 or a positive integer for write every\n'
+                              + 'and e.g. 3, 7-9 for excluded images')
+            else:
+                window['-SHOW_SUM_R-'].update(disabled=True, button_color=bc_disabled)
+                window['-CAL_R-'].update(disabled=True, button_color=bc_disabled)
+                mdist = values['-M_DIST_R-']
+                infile = m_fun.m_join(outpath, mdist)
+                reg_file = values['-REG_BASE-']
+                out_fil = m_fun.m_join(outpath, reg_file)
+                im, header = m_fun.get_fits_image(infile + str(start))
+                # 'tmp.png' needed for select_rectangle:
+                image_data, idg, actual_file = m_fun.draw_scaled_image(infile + str(start) + '.fit',
+                                                                       window['-R_IMAGE-'], opt_dict, idg,
+                                                                       contr=contrast, tmp_image=True)
+                if not sta:
+                    sta = header['M_STATIO']
+                    dat_tim = header['DATE-OBS']
+                # ===================================================================
+                # select rectangle for registration
+                select_event, x0, y0, dx, dy = m_fun.select_rectangle(infile, start, res_dict, fits_dict,
+                                                                      (wlocx, wlocy), out_fil, maxim,
+                                                                      multiple=values['-REG_MULTI-'])
+                if values['-REG_MULTI-'] and not x0:
+                    select_event = 'Cancel'  # no rectangle selected
+                if select_event == 'Ok':
+                    nsel = start + nim - 1  # nsel index of last selected image, nim number of images
+                    if nsel > nmp:
+                        nim = max(nmp - start + 1, 0)
+                        window['-N_REG-'].update(nim)
+                    t0 = time.time()
+                    fits_dict['M_STARTI'] = start
+                    reg_reference = 'stack' if values['-REG_STACK-'] else 'first'
+                    reg_predict = None if values['-REG_PREDICT-'] == 'off' else values['-REG_PREDICT-']
+                    index, sum_image, reg_text, dist, outfile, fits_dict = m_fun.register_images(start, nim, x0,
+                                y0, dx, dy, infile, out_fil, window, fits_dict, contrast, idg, values['-SHOW_REG-'],
+                                method=values['-REG_METHOD-'], reference=reg_reference,
+                                workers=workers, predict=reg_predict, exclude=reg_exclude,
+                                combine=values['-REG_COMBINE-'], write_every=write_every)
+                    t3 = time.time() - t0
+                    nim = max(index - start + 1, 1)  # tracked images
+                    n_reg = int(fits_dict.get('M_NIM', 0))  # skipped images not included
+                    if outfile:
+                        logging.info(f'time for register one image : {t3 / nim:6.2f} sec')
+                        result_text += (f'Station = {sta}\nTime = {dat_tim}\n'
+                                        + opt_comment + f'\nStart image = {str(start)}\n'
+                                        + f'Number registered images: {n_reg}\nof total images: {nmp}\n'
+                                        + f'time for register one image: {t3 / nim:6.2f} sec\n')
+                        image_data, idg, actual_file = m_fun.draw_scaled_image(outfile + '.fit', window['-R_IMAGE-'],
+                                                                               opt_dict, idg, contr=contrast)
+                        window['-SHOW_REG-'].update(True)
+                        window['-RADD-'].update(outfile)
+                        window['-SHOW_SUM_R-'].update(disabled=False, button_color=bc_enabled)
+                        window['-ADD_ROWS-'].update(disabled=False, button_color=bc_enabled)
+                    else:
+                        result_text = (f'Number registered images: {n_reg}\n'
+                                       + f'of total images: {nmp}\nno frames registered\n')
+                        sg.PopupError('no frames registered, line not found in enough images, try again!')
+                        logging.info('no frames registered, line not found in enough images')
+                    window['-RESULT3-'].update(reg_text + result_text)
+
+        elif event == '-RESTACK-':
+            # add images again with shift table of last registration
             mdist = values['-M_DIST_R-']
             infile = m_fun.m_join(outpath, mdist)
             reg_file = values['-REG_BASE-']
+            out_fil = m_fun.m_join(outpath, reg_file)
             start = int(values['-N_START_R-'])
             nim = int(values['-N_REG-'])
             nmp = int(values['-N_MAX_R-'])
-            out_fil = m_fun.m_join(outpath, reg_file)
-            im, header = m_fun.get_fits_image(infile + str(start))
-            # 'tmp.png' needed for select_rectangle:
-            image_data, idg, actual_file = m_fun.draw_scaled_image(infile + str(start) + '.fit', window['-R_IMAGE-'],
-                                                                   opt_dict, idg, contr=contrast, tmp_image=True)
-            if not sta:
-                sta = header['M_STATIO']
-                dat_tim = header['DATE-OBS']
-            # ===================================================================
-            # select rectangle for registration
-            select_event, x0, y0, dx, dy = m_fun.select_rectangle(infile, start, res_dict, fits_dict,
-                                                                  (wlocx, wlocy), out_fil, maxim)
-            if select_event == 'Ok':
-                nsel = start + nim - 1  # nsel index of last selected image, nim number of images
-                if nsel > nmp:
-                    nim = max(nmp - start + 1, 0)
-                    window['-N_REG-'].update(nim)
-                t0 = time.time()
-                fits_dict['M_STARTI'] = start
-                index, sum_image, reg_text, dist, outfile, fits_dict = m_fun.register_images(start, nim, x0,
-                            y0, dx, dy, infile, out_fil, window, fits_dict, contrast, idg, values['-SHOW_REG-'])
-                t3 = time.time() - t0
-                nim = index - start + 1
-                if nim > 1:
-                    logging.info(f'time for register one image : {t3 / nim:6.2f} sec')
-                    result_text += (f'Station = {sta}\nTime = {dat_tim}\n'
-                                    + opt_comment + f'\nStart image = {str(start)}\n'
-                                    + f'Number registered images: {nim}\nof total images: {nmp}\n'
-                                    + f'time for register one image: {t3 / nim:6.2f} sec\n')
-                    image_data, idg, actual_file = m_fun.draw_scaled_image(outfile + '.fit', window['-R_IMAGE-'],
-                                                                           opt_dict, idg, contr=contrast)
-                    window['-SHOW_REG-'].update(True)
-                    window['-RADD-'].update(outfile)
-                    window['-SHOW_SUM_R-'].update(disabled=False, button_color=bc_enabled)
-                    window['-ADD_ROWS-'].update(disabled=False, button_color=bc_enabled)
+            outfile = ''
+            t0 = time.time()
+            try:
+                workers = min(max(int(values['-WORKERS-']), 1), os.cpu_count() or 1)
+            except ValueError:
+                workers = 1
+            try:
+                write_every = int(values['-REG_WRITE-'])
+            except ValueError:
+                write_every = -1
+            if write_every < 0:
+                sg.PopupError('invalid value for write every, use 0 or a positive integer')
+            else:
+                try:
+                    reg_exclude = m_fun.parse_index_list(values['-REG_EXCL-'])
+                    index, sum_image, reg_text, dist, outfile, fits_dict = m_fun.restack_images(start, nim, infile,
+                                out_fil, window, fits_dict, contrast, idg, values['-SHOW_REG-'], exclude=reg_exclude,
+                                workers=workers, combine=values['-REG_COMBINE-'], write_every=write_every)
+                except (OSError, ValueError) as e:
+                    sg.PopupError(f'restack not possible, register images first\n{e}')
+                    logging.info(f'restack not possible: {e}')
                 else:
-                    result_text = (f'Number registered images: {nim}\n'
-                                   + f'of total images: {nmp}\nnot enough images\n')
-                    sg.PopupError(f'register did not work with last image, try again!')
-                    logging.info(f'register did not work with last image, try again!')
-                window['-RESULT3-'].update(reg_text + result_text)
+                    if outfile:
+                        t3 = time.time() - t0
+                        logging.info(f'time for restack: {t3:6.2f} sec')
+                        result_text = (f'Start image = {fits_dict["M_STARTI"]}\n'
+                                       + f'Number registered images: {fits_dict["M_NIM"]}\nof total images: {nmp}\n'
+                                       + f'time for restack: {t3:6.2f} sec\n')
+                        image_data, idg, actual_file = m_fun.draw_scaled_image(outfile + '.fit', window['-R_IMAGE-'],
+                                                                               opt_dict, idg, contr=contrast)
+                        window['-SHOW_REG-'].update(True)
+                        window['-RADD-'].update(outfile)
+                        window['-SHOW_SUM_R-'].update(disabled=False, button_color=bc_enabled)
+                        window['-ADD_ROWS-'].update(disabled=False, button_color=bc_enabled)
+                        window['-RESULT3-'].update(reg_text + result_text)
+                    else:
+                        sg.PopupError('not enough images for restack')
 
         # =======================================================================
         # convert 2-D spectrum to 1-D spectrum
@@ -823,6 +939,18 @@ def main():
                                                                        opt_dict, idg, contr=contrast)
                 window['-RADD-'].update(outfile)
 
+        elif event == '-CUBE-':
+            # time resolved spectra from registered images, with tilt, slant and rows of sum image
+            reg_base = outfile[:outfile.rfind('_add')] if '_add' in outfile else out_fil
+            try:
+                cube_file, curves = m_fun.save_spectral_cube(outfile, reg_base, fits_dict)
+                info = f'spectral cube: {cube_file}\nlight curves: ' + ', '.join(name for name, x, c in curves)
+                logging.info(info)
+                result_text += info + '\n'
+                window['-RESULT3-'].update(reg_text + result_text)
+            except (OSError, ValueError) as e:
+                sg.PopupError(f'spectral cube not possible\n{e}')
+
         # =======================================================================
         elif event is '-LOAD_R-':
             # load existing file for adding rows and apply tilt and slant
@@ -830,6 +958,7 @@ def main():
             outfile = values['-RADD-']
             window['-SAVE_RAW-'].update(disabled=True, button_color=bc_disabled)
             window['-CAL_R-'].update(disabled=True, button_color=bc_disabled)
+            window['-CUBE-'].update(disabled=True, button_color=bc_disabled)
             outfile = sg.PopupGetFile('', title='Get Registered File', no_window=True,
                                       file_types=(('Image Files', '*.fit'), ('ALL Files', '*.*'),),
                                       default_path=outfile)
@@ -865,7 +994,7 @@ def main():
 
         elif event is '-SAVE_RAW-':
             imtilt, header = m_fun.get_fits_image(outfile + 'st')
-            lcal, ical = np.loadtxt(outfile + '.dat', unpack=True, ndmin=2)
+            lcal, ical = m_fun.load_spectrum(outfile + '.dat')
             # default values for fits_dict:
             fits_dict['M_TILT'] = 0.0
             fits_dict['M_SLANT'] = 0.0
@@ -899,6 +1028,7 @@ def main():
                                                 default_path=raw_spec_file)
             window.TKroot.title(window_title + raw_spec_file)
             window['-S_LINES-'].update(disabled=True, button_color=bc_disabled)
+            window['-AUTO_L-'].update(disabled=True, button_color=bc_disabled)
             window['-SPEC_R-'].update(raw_spec_file)
             if raw_spec_file:
                 m_fun.create_line_list_combo(line_list, window)
@@ -907,6 +1037,7 @@ def main():
                 # plot raw spectrum
                 lmin, lmax, i_min, i_max, lcal, ical = m_plot.plot_raw_spectrum(raw_spec_file, graph, canvasx)
                 window['-S_LINES-'].update(disabled=False, button_color=bc_enabled)
+                window['-AUTO_L-'].update(disabled=False, button_color=bc_enabled)
                 window['-LOAD_TABLE-'].update(disabled=False, button_color=bc_enabled)
                 llist = m_fun.change_extension(raw_spec_file, '.txt')
                 graph_enabled = True
@@ -949,6 +1080,40 @@ def main():
                 start_point, end_point = None, None  # enable grabbing a new rect
                 dragging = False
 
+        # ==============================================================================
+        # identify calibration lines automatically
+        elif event == '-AUTO_L-':
+            try:
+                disp0 = float(fits_dict['D_DISP0'])
+            except:
+                disp0 = 0.0
+            if not disp0:
+                disp_text = sg.PopupGetText('select value for disp0:',
+                                            title='linear dispersion [nm/Pixel]', default_text='1.0')
+                try:
+                    disp0 = float(disp_text)
+                except (TypeError, ValueError):  # Cancel or no number
+                    disp0 = 0.0
+            if disp0:
+                deg = max(int(values['-POLY-']), 1)
+                table, cal_text_file = m_fun.identify_calibration_lines(lcal, ical, line_list, disp0, deg=deg)
+                if len(table) < 2:
+                    sg.PopupError('Auto Lines: not enough lines identified, use Select Lines', title='Auto Lines')
+                else:
+                    for (xl, lam) in table:
+                        graph.DrawLine((xl, i_min), (xl, i_max), 'blue', 1)
+                    cal_text_file = ' Pixel    width  lambda    fit    delta\n' + cal_text_file
+                    result_text += cal_text_file
+                    window['-RESULT4-'].update(result_text, disabled=True)
+                    llist = m_fun.change_extension(raw_spec_file, '.txt')
+                    with open(llist, 'w+') as f:
+                        np.savetxt(f, table, fmt='%8.2f', header='    x     lambda')
+                    xcalib, lcalib = np.loadtxt(llist, unpack=True, ndmin=2)
+                    logging.info(f'table saved as {llist}')
+                    window['-CALI-'].update(disabled=False, button_color=bc_enabled)
+                    table_edited = False
+                    select_line_enabled = False
+
         # ==============================================================================
         # select single calibration line
         elif event is '-S_LINE-':
@@ -1026,8 +1191,11 @@ def main():
                                              title='linear dispersion [nm/Pixel]', default_text=str(disp0)))
                 c = [disp, lcalib[0] - disp * xcalib[0]]
             if len(c):
+                rebin = 'flux' if values['-FLUX-'] else 'quadratic'
+                response = m_fun.get_response(values['-RESP-'], fits_dict)
                 cal_dat_file, spec_file, lmin, lmax, cal_text_file = m_fun.calibrate_raw_spectrum(raw_spec_file,
-                                                                            xcalib, lcalib, deg, c)
+                                                                            xcalib, lcalib, deg, c, rebin,
+                                                                            response)
                 logging.info(f'spectrum {spec_file} saved')
                 window['-RESULT4-'].update(result_text + cal_text_file, disabled=True)
                 window['-PLOT_SPEC-'].update(spec_file)
@@ -1039,17 +1207,74 @@ def main():
                 video_list.insert(0, ' ')
                 window['-PLOT_TITLE-'].update(values=video_list)
 
+        # ==============================================================================
+        # apply saved wavelength solution to several raw spectra
+        elif event == '-BATCH_C-':
+            sol_file = sg.PopupGetFile('', title='Load wavelength solution', no_window=True, save_as=False,
+                                       file_types=(('Wavelength solution', '*cal.ini'), ('ALL Files', '*.*'),),
+                                       default_path=m_fun.change_extension(raw_spec_file, 'cal.ini'))
+            if sol_file:
+                raw_files = sg.PopupGetFile('', title='Select raw spectra', no_window=True, save_as=False,
+                                            multiple_files=True,
+                                            file_types=(('Spectrum Files', '*.dat'), ('Spectral cubes', '*_cube.fit'),
+                                                        ('ALL Files', '*.*'),),
+                                            default_path=raw_spec_file)
+                if raw_files:
+                    try:
+                        solution = m_fun.read_wavelength_solution(sol_file)
+                        if isinstance(raw_files, str):
+                            raw_files = raw_files.split(';')
+                        rebin = 'flux' if values['-FLUX-'] else 'quadratic'
+                        cubes = [f for f in raw_files if f.endswith('.fit')]
+                        spectra = [f for f in raw_files if not f.endswith('.fit')]
+                        response = m_fun.get_response(values['-RESP-'], fits_dict)
+                        calibrated = m_fun.calibrate_raw_spectra(spectra, solution, rebin, response)
+                        result_text += f'wavelength solution {sol_file}\npolynom: {solution["c"]}\n'
+                        for (cal_dat_file, batch_file) in calibrated:
+                            result_text += f'spectrum {cal_dat_file} saved\n'
+                        for cube_file in cubes:
+                            cal_file = m_fun.calibrate_spectral_cube(cube_file, solution, rebin, response)
+                            result_text += f'cube {cal_file} saved\n'
+                        window['-RESULT4-'].update(result_text, disabled=True)
+                    except (OSError, ValueError, KeyError) as e:
+                        logging.info(f'batch calibration with {sol_file} failed: {e}')
+                        sg.PopupError(f'batch calibration with {sol_file} failed\n{e}', title='Batch calibration')
+
+        # ==============================================================================
+        # build instrument response from reference spectrum
+        elif event == '-RESP_B-':
+            ref_file = sg.PopupGetFile('', title='Calibrated spectrum of reference', no_window=True, save_as=False,
+                                       file_types=(('Spectrum Files', '*.dat'), ('ALL Files', '*.*'),),
+                                       default_path=spec_file)
+            if ref_file:
+                reference = sg.PopupGetText('reference spectrum (wavelength, flux) or black body temperature [K]',
+                                            title='Instrument response', default_text='3000')
+                if reference:
+                    try:
+                        if not path.exists(reference):
+                            reference = float(reference)
+                        response = m_fun.build_response(ref_file, reference)
+                        resp_file = m_fun.response_file(fits_dict)
+                        m_fun.save_response(resp_file, response)
+                        result_text += f'instrument response {resp_file} saved\n'
+                        window['-RESULT4-'].update(result_text, disabled=True)
+                    except (OSError, ValueError, KeyError) as e:
+                        logging.info(f'cannot build response from {ref_file} and {reference}: {e}')
+                        sg.PopupError(f'cannot build response from {ref_file} and {reference}\n{e}',
+                                      title='Instrument response')
+
         # ==============================================================================
         # load (un)calibrated spectrum
         if event is '-LOADS-':
             window['-S_LINES-'].update(disabled=True, button_color=bc_disabled)
+            window['-AUTO_L-'].update(disabled=True, button_color=bc_disabled)
             spec_file = sg.PopupGetFile('', title='Load spectrum', no_window=True, save_as=False,
                                         file_types=(('Spectrum Files', '*.dat'), ('ALL Files', '*.*'),),
                                         default_path=spec_file)
             if spec_file:
                 window.TKroot.title(window_title + spec_file)
                 result_text += f'File {spec_file} loaded\n'
-                lspec, ispec = np.loadtxt(spec_file, unpack=True, ndmin=2)
+                lspec, ispec = m_fun.load_spectrum(spec_file)
                 logging.info(f'spectrum {spec_file} loaded')
                 lmin = lspec[0]
                 lmax = lspec[len(lspec) - 1]
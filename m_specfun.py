@@ -4,21 +4,24 @@
 # -------------------------------------------------------------------
 import configparser
 import ctypes
+import glob
 import logging
 import os
 import os.path as path
 import platform
+import re
 import subprocess
 import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, date
+from functools import lru_cache
 
 import PySimpleGUI as sg
 import numpy as np
 from astropy.io import fits
 from astropy.time import Time
-from scipy import optimize, interpolate
-from scipy.ndimage import map_coordinates
+from scipy import optimize, fft, ndimage, signal, sparse
 from skimage import img_as_float
 from skimage import transform as tf
 from skimage import io as ios
@@ -658,41 +661,246 @@ mode : {'constant', 'edge', 'symmetric', 'reflect', 'wrap'}, optional
 
 # -------------------------------------------------------------------
 
-def register_images(start, nim, x0, y0, dx, dy, infile, outfil, window, fits_dict, contr=1, idg=0, show_reg=False):
+def register_images(start, nim, x0, y0, dx, dy, infile, outfil, window, fits_dict, contr=1, idg=0, show_reg=False,
+                    method='gauss', reference='first', workers=1, predict=None, exclude=(), combine='mean',
+                    write_every=1):
     """
+    registers images in two steps:
+    track_images follows the selected line from image to image and measures the shifts,
+    stack_images shifts the images, writes the registered images and adds them,
+    with workers > 1 in parallel processes
+    with several selected rectangles (lists of x0, y0, dx, dy) each line is tracked
+    and the images are registered with a similarity transform (shift, rotation, scale)
+    the measured positions are saved in outfil + '_shift.txt' for restack_images
     :param start: index of first image (reference) for registering
     :param nim: number of images to register_images
-    :param x0: x-coordinate of reference pixel (int)
-    :param y0: y-coordinate of reference pixel (int)
-    :param dx: half width of selected rectangle
-    :param dy: half height of selected rectangle
+    :param x0: x-coordinate of reference pixel (int), or list for several lines
+    :param y0: y-coordinate of reference pixel (int), or list for several lines
+    :param dx: half width of selected rectangle, or list for several lines
+    :param dy: half height of selected rectangle, or list for several lines
     :param infile: full filebase of images e.g. out/mdist
     :param outfil: filebase of registered files, e.g. out/mdist
     :param window: GUI window for displaying results of registered files
     :param fits_dict: content of fits-header
-    if the procedure stops early, nim = index - start + 1
+    :param method: 'gauss': position of line from 2-D Gaussian fit in selected rectangle,
+                   'fft': shift from phase correlation of selected rectangle with reference
+    :param reference: only used for method 'fft',
+                   'first': reference is the selected rectangle of the start image,
+                   'stack': reference is the running sum of the registered rectangles
+    :param workers: number of processes for shifting and adding images
+    :param predict: motion model for the position of the rectangle in the next image,
+                   None, 'velocity' or 'acceleration', see track_images
+    :param exclude: indices of images which are tracked but not added
+    :param combine: 'mean', 'median', 'clip' (sigma clipped mean) or 'snr' (mean weighted with
+                   the peak of the line), see combine_images
+    :param write_every: 1: all registered images are saved, K: only every Kth image,
+                   0: only the sum image and the shift table (stack only),
+                   combine other than 'mean' needs all registered images
+    images where the line was not found are skipped, the number of added images is stored in M_NIM,
+    success is given by outfile, '' if no images were added
     :return:
     index: last processed image
     sum_image: !average! of registered images
     regtext: multiline text of results
     dist: if True, distorted images, else False
-    outfile: filename of sum-image, e.g. for sum of 20 added images: out/r_add20
+    outfile: filename of sum-image, e.g. for sum of 20 added images: out/r_add20,
+             '' if less than 2 images were registered
     fits_dict: updated values of fits-header
     """
+    rectangles = list(zip(*[v.astype(int) for v in np.broadcast_arrays(*np.atleast_1d(x0, y0, dx, dy))]))
+    tables = []
+    regtext = ''
+    for feature, (xf, yf, dxf, dyf) in enumerate(rectangles):
+        if len(rectangles) > 1:
+            regtext += f'line {feature + 1}\n'
+        table, text, dist = track_images(start, nim, xf, yf, dxf, dyf, infile, fits_dict, window,
+                                         method=method, reference=reference, predict=predict)
+        regtext += text
+        tables.append(np.column_stack([table, np.full(len(table), feature)]))
+    table = np.concatenate(tables)
+    key = {'infile': infile, 'x0': x0, 'y0': y0, 'dx': dx, 'dy': dy, 'method': method,
+           'reference': reference, 'predict': predict, 'dist': dist}
+    write_shift_table(outfil + '_shift.txt', table, key)
+    return _add_registered(start, table, infile, outfil, window, fits_dict, dist, regtext, exclude=exclude,
+                           workers=workers, contr=contr, idg=idg, show_reg=show_reg, combine=combine,
+                           write_every=write_every)
 
-    def _shift(xy):
-        return xy - np.array(dxy)[None, :]
 
-    index = start
+# -------------------------------------------------------------------
+
+def restack_images(start, nim, infile, outfil, window, fits_dict, contr=1, idg=0, show_reg=False,
+                   exclude=(), workers=1, combine='mean', write_every=1):
+    """
+    adds registered images with the shifts saved by register_images in outfil + '_shift.txt',
+    for a different start, number of images or excluded images without repeating the tracking
+    parameters and results as register_images
+    :param exclude: indices of images which are not added
+    """
+    table, key = read_shift_table(outfil + '_shift.txt')
+    if key.get('infile') != infile:
+        raise ValueError(f'shift table {outfil}_shift.txt is for images {key.get("infile")}')
+    dist = key.get('dist') == 'True'
+    table = table[(table[:, 0] >= start) & (table[:, 0] < start + nim)]
+    regtext = (f'restack {infile} with {outfil}_shift.txt\n'
+               + f'x y, dx dy: {key.get("x0")} {key.get("y0")}, {key.get("dx")} {key.get("dy")}, '
+               + f'method: {key.get("method")}\n')
+    return _add_registered(start, table, infile, outfil, window, fits_dict, dist, regtext, exclude=exclude,
+                           workers=workers, contr=contr, idg=idg, show_reg=show_reg, combine=combine,
+                           write_every=write_every)
+
+
+# -------------------------------------------------------------------
+
+def _add_registered(start, table, infile, outfil, window, fits_dict, dist, regtext, exclude=(), workers=1,
+                    contr=1, idg=0, show_reg=False, combine='mean', write_every=1):
+    """
+    common part of register_images and restack_images, stacks the images of the shift table
+    with all lines found and not excluded, writes the average
+    for combine other than 'mean' the registered images are combined with combine_images
+    the transforms of the images and the numbers of the saved registered images
+    are written to outfil + '_transform.txt', used by spectral_cube
+    :return: see register_images
+    """
     sum_image = []
     outfile = ''
-    dist = False
     fits_dict.pop('M_NIM', None)  # M_NIM only defined for added images
+    index = int(table[:, 0].max()) if len(table) else start - 1
+    table = table[(table[:, 6] > 0) & ~np.isin(table[:, 0], list(exclude))]
+    transforms = similarity_transforms(table)
+    nim = len(transforms)
+    if nim > 1:
+        try:
+            if combine != 'mean':
+                write_every = 1
+            # same numbering as stack_images, 0: registered image not saved
+            saved = [n + 1 if write_every and n % write_every == 0 else 0 for n in range(nim)]
+            np.savetxt(outfil + '_transform.txt', np.column_stack([transforms, saved]),
+                       fmt='%6i %10.7f %10.7f %9.4f %9.4f %5i',
+                       header='transform of image to start image: x\' = a*x - b*y + tx, y\' = b*x + a*y + ty\n'
+                              + ' index     a          b          tx        ty    file')
+            sum_image = stack_images(transforms, infile, outfil, fits_dict, dist, window, workers=workers,
+                                     contr=contr, idg=idg, show_reg=show_reg, write_every=write_every)
+            if combine == 'mean':
+                sum_image = sum_image / nim  # averaging
+            else:
+                reg_files = [outfil + str(n + 1) + '.fit' for n in range(nim)]
+                lines = table[table[:, 7] == 0]
+                weights = lines[np.isin(lines[:, 0], transforms[:, 0]), 3]
+                sum_image = combine_images(reg_files, method=combine, weights=weights)
+        except Exception as e:
+            info = f'problem with register_images, stacking of images: {e}'
+            logging.info(info)
+            regtext += info + '\n'
+            return start - 1, [], regtext, dist, outfile, fits_dict
+        outfile = outfil + '_add' + str(nim)
+        fits_dict['M_STARTI'] = str(int(transforms[0, 0]))
+        fits_dict['M_NIM'] = str(nim)
+        write_fits_image(sum_image, outfile + '.fit', fits_dict, dist=dist)
+    return index, sum_image, regtext, dist, outfile, fits_dict
+
+
+# -------------------------------------------------------------------
+
+def write_shift_table(filename, table, key):
+    """
+    saves the result of track_images
+    :param filename: e.g. out/r_shift.txt
+    :param table: array from track_images, with number of line as additional column
+    :param key: dictionary with parameters of the registration, e.g. infile, rectangle, method
+    """
+    header = ('shift table of registered images\n'
+              + '; '.join(f'{k}={v}' for k, v in key.items()) + '\n'
+              + ' index     x         y        peak  fwhm_x  fwhm_y status line')
+    np.savetxt(filename, table, fmt='%6i %9.4f %9.4f %8.4f %7.3f %7.3f %4i %4i', header=header)
+
+
+# -------------------------------------------------------------------
+
+def read_shift_table(filename):
+    """
+    reads the shift table saved by register_images
+    :param filename: e.g. out/r_shift.txt
+    :return: table: array as from track_images, with number of line as additional column
+             key: dictionary with parameters of the registration, values as strings
+    """
+    with open(filename, encoding='utf-8') as f:
+        f.readline()
+        key_line = f.readline().lstrip('# ').rstrip('\n')
+    key = dict(item.strip().split('=', 1) for item in key_line.split(';') if '=' in item)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # empty table
+        table = np.loadtxt(filename, ndmin=2)
+    return table.reshape(-1, 8), key
+
+
+# -------------------------------------------------------------------
+
+def parse_index_list(text):
+    """
+    converts a list of image indices to integers
+    :param text: comma separated indices or ranges, e.g. '3, 7-9'
+    :return: list of indices, e.g. [3, 7, 8, 9]
+    """
+    indices = []
+    for item in text.replace(' ', '').split(','):
+        if '-' in item:
+            first, last = item.split('-', 1)
+            indices += list(range(int(first), int(last) + 1))
+        elif item:
+            indices.append(int(item))
+    return indices
+
+
+# -------------------------------------------------------------------
+
+def track_images(start, nim, x0, y0, dx, dy, infile, fits_dict, window=None, method='gauss', reference='first',
+                 predict=None, max_missed=3, min_peak=0.1, width_tol=2.0):
+    """
+    tracking step of register_images, follows the selected line from image to image
+    the rectangle for the next image is centered at the line position of the actual image
+    or, with predict, at the position forecast by a Kalman filter
+    if the Gaussian fit fails, it is repeated with a rectangle of double size,
+    for method 'fft' with a rectangle centered at the brightest pixel of the rectangle of double size,
+    lines with a peak below min_peak * peak of the start image or a FWHM different
+    by more than a factor width_tol from the last line found are rejected (noise),
+    images where the line is not found are skipped,
+    tracking stops after max_missed consecutive images without line
+    :param start: index of first image (reference) for registering
+    :param nim: number of images to track
+    :param x0: x-coordinate of reference pixel (int)
+    :param y0: y-coordinate of reference pixel (int)
+    :param dx: half width of selected rectangle
+    :param dy: half height of selected rectangle
+    :param infile: full filebase of images e.g. out/mdist
+    :param fits_dict: content of fits-header, M_BOB is updated
+    :param window: GUI window for displaying results, None for use without GUI
+    :param method: 'gauss' or 'fft', see register_images
+    :param reference: 'first' or 'stack', see register_images
+    :param predict: None: no prediction, 'velocity' or 'acceleration': motion model of Kalman filter,
+                    for method 'gauss' the size of the rectangle is adapted to the line width
+                    and the uncertainty of the predicted position
+    :param max_missed: number of consecutive images without line found before tracking stops
+    :param min_peak: minimum peak of line relative to peak in start image
+    :param width_tol: maximum ratio of FWHM to FWHM of last line found
+    :return:
+    table: array with one row for each tracked image:
+           index, x, y (position of line, column and row), peak, FWHM in x and y,
+           status: 1: line found, 2: line found with larger rectangle, 0: not found, image skipped
+    regtext: multiline text of results
+    dist: if True, distorted images, else False
+    """
+    index = start
+    table = []
+    dist = False
+    kf = None
+    missed = 0
+    min_height = 0.0  # set from start image
+    fwhm = None  # FWHM in x and y of last line found
+    (rx, ry) = (dx, dy)  # half size of rectangle, adapted with predict
     logging.info(f'start x y, dx dy, file: {x0} {y0},{2 * dx} {2 * dy}, {infile}')
     regtext = f'start x y, dx dy, file: {x0} {y0},{2 * dx} {2 * dy}, {infile}' + '\n'
     image_list = create_file_list(infile, nim, ext='', start=start)
     regtext += f'        file        peak      x         y    wx   wy\n'
-
     try:
         for image_file in image_list:
             im, header = get_fits_image(image_file)
@@ -702,83 +910,511 @@ def register_images(start, nim, x0, y0, dx, dy, infile, outfil, window, fits_dic
                 fits_dict['M_BOB'] = header['M_BOB']
             if len(im.shape) == 3:
                 imbw = np.sum(im, axis=2)  # used for _fit_gaussian_2d(data)
+            else:
+                imbw = im
+            status = 1
+            if kf:
+                (xp, yp), (sx, sy) = _kalman_predict(kf)
+                x0 = int(round(xp))
+                y0 = int(round(yp))
+                if method == 'gauss' and fwhm is not None:
+                    # rectangle from width of last line found and uncertainty of prediction
+                    rx = int(np.clip(np.ceil(fwhm[0] + 3 * sx), 4, 2 * dx))
+                    ry = int(np.clip(np.ceil(fwhm[1] + 3 * sy), 4, 2 * dy))
+            if method == 'fft':
+                # selected area
                 data = imbw[y0 - dy:y0 + dy, x0 - dx:x0 + dx]
-                shifted = im
-            # selected area
+                if index == start:
+                    if data.shape != (2 * dy, 2 * dx):
+                        raise ValueError('rectangle outside image')
+                    # reference rectangle, line position from moments
+                    (height, x, y, width_x, width_y) = _moments(data)  # x and y reversed
+                    height -= np.median(data)  # peak above background, as in _correlate_line
+                    ref_fft = _phase_correlation_reference(data)
+                    ref_roi = (y0 - dy, x0 - dx)
+                    ref_xy = (y + x0 - dx, x + y0 - dy)
+                    ref_sum = np.array(data, dtype=float)
+                    line = (height, ref_xy[0], ref_xy[1], width_y, width_x)
+                else:
+                    line = _check_line(_correlate_line(imbw, x0, y0, dx, dy, ref_fft, ref_roi, ref_xy),
+                                       min_height, fwhm, width_tol)
+                    if line is None:
+                        # retry with rectangle centered at brightest pixel of rectangle of double size
+                        (xb, yb) = _brightest_pixel(imbw, x0, y0, 2 * dx, 2 * dy)
+                        line = _check_line(_correlate_line(imbw, xb, yb, dx, dy, ref_fft, ref_roi, ref_xy),
+                                           min_height, fwhm, width_tol)
+                        status = 2
             else:
-                data = im[y0 - dy:y0 + dy, x0 - dx:x0 + dx]
-            params, success = _fit_gaussian_2d(data)
-            (height, x, y, width_x, width_y) = params  # x and y reversed
-            width_x = 2 * np.sqrt(2 * np.log(2)) * np.abs(width_x)  # FWHM
-            width_y = 2 * np.sqrt(2 * np.log(2)) * np.abs(width_y)  # FWHM
-            # full image
-            x = x + y0 - dy  # y and x reversed
-            y = y + x0 - dx
+                line = _fit_line(imbw, x0, y0, rx, ry, min_height, fwhm, width_tol)
+                if line is None and index > start:
+                    # retry with larger rectangle
+                    line = _fit_line(imbw, x0, y0, 2 * rx, 2 * ry, min_height, fwhm, width_tol)
+                    status = 2
             imagename = os.path.basename(image_file)
-            info = f'{imagename:12s} {height:7.3f} {y:6.1f} {x:6.1f} {width_y:5.2f} {width_x:5.2f}'
-            regtext += info + '\n'
-            window['-RESULT3-'].update(regtext)
-            window.refresh()
-            logging.info(info)
-            if index == start:  # reference position for register_images
-                x00 = y
-                y00 = x
-            # register_images
-            dxy = [x00 - y, y00 - x]
-            if len(im.shape) == 3:
-                for c in [0, 1, 2]:  # separate color planes for faster processing
-                    im2 = im[:, :, c]
-                    coords = tf.warp_coords(_shift, im2.shape)
-                    sh2 = map_coordinates(im2, coords)  # / 255
-                    shifted[:, :, c] = sh2
-            else:
-                coords = tf.warp_coords(_shift, im.shape)
-                shifted = map_coordinates(im, coords)  # / 255
-            if index == start:  # reference position for register_images
-                sum_image = shifted
-
+            if line is None:
+                if index == start:
+                    raise ValueError('no line found in start image')
+                missed += 1
+                info = f'{imagename:12s} line not found, image skipped'
+                table.append((index, np.nan, np.nan, 0.0, np.nan, np.nan, 0))
             else:
-                sum_image += shifted
-            # write image as fit-file
-            write_fits_image(shifted, outfil + str(index - start + 1) + '.fit', fits_dict, dist=dist)
-            if show_reg:
-                image_data, idg, actual_file = draw_scaled_image(outfil + str(index - start + 1) + '.fit',
-                                                                 window['-R_IMAGE-'], opt_dict, idg, contr=contr,
-                                                                 resize=True, tmp_image=True)
-                window.set_title('Register: ' + str(actual_file))
+                missed = 0
+                (height, x, y, width_x, width_y) = line
+                width_x = 2 * np.sqrt(2 * np.log(2)) * np.abs(width_x)  # FWHM
+                width_y = 2 * np.sqrt(2 * np.log(2)) * np.abs(width_y)  # FWHM
+                if index == start:
+                    min_height = min_peak * height
+                fwhm = (width_x, width_y)
+                info = f'{imagename:12s} {height:7.3f} {x:6.1f} {y:6.1f} {width_x:5.2f} {width_y:5.2f}'
+                table.append((index, x, y, height, width_x, width_y, status))
+                if method == 'fft' and reference == 'stack' and index > start:
+                    # add registered rectangle to reference, only the surrounding of the rectangle is shifted
+                    dxy = [table[0][1] - x, table[0][2] - y]
+                    ref_sum += _shift_rectangle(imbw, ref_roi, ref_sum.shape, dxy)
+                    ref_fft = _phase_correlation_reference(ref_sum)
+                if predict:
+                    if kf:
+                        _kalman_update(kf, x, y)
+                    else:
+                        kf = _kalman_init(x, y, model=predict)
+                # set new start value
+                x0 = int(x)
+                y0 = int(y)
+            regtext += info + '\n'
+            if window:
+                window['-RESULT3-'].update(regtext)
                 window.refresh()
-            # set new start value
-            x0 = int(y)
-            y0 = int(x)
+            logging.info(info)
+            if missed >= max_missed:
+                raise ValueError(f'no line found in {missed} images')
             index += 1  # next image
-        index += -1
     except:
-        # Exception, delete last image with error
-        if path.exists(outfil + str(index - start + 1) + '.fit'):
-            os.remove(outfil + str(index - start + 1) + '.fit')
-        index += -1
-        info = f'problem with register_images, last image: {image_file}, number of images: {index}'
+        info = f'problem with register_images, last image: {image_file}, number of images: {len(table)}'
         logging.info(info)
         regtext += info + '\n'
-    nim = index - start + 1
-    if nim > 1:
-        if index == nim + start - 1:
-            outfile = outfil + '_add' + str(nim)
-            sum_image = sum_image / nim  # averaging
-            fits_dict['M_STARTI'] = str(start)
-            fits_dict['M_NIM'] = str(nim)
-            write_fits_image(sum_image, outfile + '.fit', fits_dict, dist=dist)
-    return index, sum_image, regtext, dist, outfile, fits_dict
+    return np.array(table).reshape(-1, 7), regtext, dist
+
+
+# -------------------------------------------------------------------
+
+def _fit_line(imbw, x0, y0, dx, dy, min_height=0.0, fwhm=None, width_tol=2.0):
+    """
+    fits 2-D Gaussian to the line in a rectangle of the image
+    :param imbw: b/w image
+    :param x0: x-coordinate of center of rectangle (int)
+    :param y0: y-coordinate of center of rectangle (int)
+    :param dx: half width of rectangle
+    :param dy: half height of rectangle
+    :param min_height: minimum peak of line
+    :param fwhm: (FWHM in x, FWHM in y) of the last line found, None: width not checked
+    :param width_tol: maximum ratio of FWHM of fit and fwhm (or inverse)
+    :return: (height, x, y, width_x, width_y) of line in image coordinates,
+             None if the fit failed, the line is outside the rectangle or too faint or
+             the width does not match fwhm (fit of noise)
+    """
+    r0 = max(y0 - dy, 0)
+    c0 = max(x0 - dx, 0)
+    data = imbw[r0:y0 + dy, c0:x0 + dx]
+    if min(data.shape) < 3:
+        return None
+    try:
+        params, success = _fit_gaussian_2d(data)
+    except (ValueError, IndexError):  # no line, moments outside rectangle
+        return None
+    (height, x, y, width_x, width_y) = params  # x and y reversed
+    if (success not in (1, 2, 3, 4) or height <= 0 or not (0 <= x < data.shape[0] and 0 <= y < data.shape[1])
+            or not (0.3 < abs(width_x) < data.shape[0] and 0.3 < abs(width_y) < data.shape[1])):
+        return None
+    return _check_line((height, y + c0, x + r0, width_y, width_x), min_height, fwhm, width_tol)
+
+
+# -------------------------------------------------------------------
+
+def _check_line(line, min_height=0.0, fwhm=None, width_tol=2.0):
+    """
+    rejects a measured line which is too faint or has a width different from the last line found,
+    used for both methods of track_images
+    :param line: (height, x, y, width_x, width_y), widths as sigma, or None
+    :param min_height: minimum peak of line
+    :param fwhm: (FWHM in x, FWHM in y) of the last line found, None: width not checked
+    :param width_tol: maximum ratio of FWHM of line and fwhm (or inverse)
+    :return: line, None if rejected (noise)
+    """
+    if line is None or line[0] < min_height:
+        return None
+    if fwhm is not None:
+        ratio = 2 * np.sqrt(2 * np.log(2)) * np.abs(line[3:5]) / np.asarray(fwhm)
+        if np.any(ratio > width_tol) or np.any(ratio < 1 / width_tol):
+            return None
+    return line
+
+
+# -------------------------------------------------------------------
+
+def _brightest_pixel(imbw, x0, y0, dx, dy):
+    """
+    position of the brightest pixel in a rectangle of the smoothed image, used to
+    recenter the rectangle if the line is not found
+    :param imbw: b/w image
+    :param x0: x-coordinate of center of rectangle (int)
+    :param y0: y-coordinate of center of rectangle (int)
+    :param dx: half width of rectangle
+    :param dy: half height of rectangle
+    :return: x, y of brightest pixel (int)
+    """
+    r0 = max(y0 - dy, 0)
+    c0 = max(x0 - dx, 0)
+    data = ndimage.gaussian_filter(np.asarray(imbw[r0:y0 + dy, c0:x0 + dx], dtype=float), 1.0)
+    if not data.size:
+        return x0, y0
+    (r, c) = np.unravel_index(np.argmax(data), data.shape)
+    return int(c0 + c), int(r0 + r)
 
 
 # -------------------------------------------------------------------
 
-def _gaussian(height, center_x, center_y, width_x, width_y):
-    """Returns a _gaussian function with the given parameters"""
-    width_x = float(width_x)
-    width_y = float(width_y)
-    return lambda x, y: height * np.exp(
-        -(((center_x - x) / width_x) ** 2 + ((center_y - y) / width_y) ** 2) / 2)
+def _correlate_line(imbw, x0, y0, dx, dy, ref_fft, ref_roi, ref_xy):
+    """
+    position of the line from the phase correlation of a rectangle of the image with the reference,
+    peak and width of the line from the _moments of the rectangle
+    :param imbw: b/w image
+    :param x0: x-coordinate of center of rectangle (int)
+    :param y0: y-coordinate of center of rectangle (int)
+    :param dx: half width of rectangle, same size as reference
+    :param dy: half height of rectangle
+    :param ref_fft: reference, from _phase_correlation_reference
+    :param ref_roi: (row, column) of upper left corner of reference rectangle
+    :param ref_xy: (x, y) position of line in reference image
+    :return: (height, x, y, width_x, width_y) of line in image coordinates,
+             None if the rectangle is outside the image or no line is found (noise)
+    """
+    data = imbw[y0 - dy:y0 + dy, x0 - dx:x0 + dx]
+    if y0 - dy < 0 or x0 - dx < 0 or data.shape != (2 * dy, 2 * dx):
+        return None
+    try:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            (height, x, y, width_x, width_y) = _moments(data)
+        shift_r, shift_c = _phase_correlation_shift(ref_fft, imbw, (y0 - dy, x0 - dx), (2 * dy, 2 * dx))
+    except (ValueError, IndexError):
+        return None
+    height -= np.median(data)  # peak above background
+    line = (height, ref_xy[0] + x0 - dx - ref_roi[1] + shift_c, ref_xy[1] + y0 - dy - ref_roi[0] + shift_r,
+            width_y, width_x)
+    if height <= 0 or not np.all(np.isfinite(line)):
+        return None
+    return line
+
+
+# -------------------------------------------------------------------
+
+def _kalman_init(x, y, model='velocity', r=0.25, q=0.1):
+    """
+    Kalman filter for the line position in the image series, time step is one image
+    :param x: x-coordinate of line in first image
+    :param y: y-coordinate of line in first image
+    :param model: 'velocity': constant velocity, 'acceleration': constant acceleration
+    :param r: variance of measured position [pixel^2]
+    :param q: variance of random change of velocity or acceleration per image
+    :return: dictionary with state s (x, y, vx, vy, (ax, ay)), covariance p
+             and model matrices f, q, h, r
+    """
+    if model == 'acceleration':
+        f1 = np.array([[1.0, 1.0, 0.5], [0.0, 1.0, 1.0], [0.0, 0.0, 1.0]])
+        g = np.array([1 / 6, 0.5, 1.0])
+        p0 = [r, 100.0, 1.0]  # initial velocity unknown, acceleration small
+    else:
+        f1 = np.array([[1.0, 1.0], [0.0, 1.0]])
+        g = np.array([0.5, 1.0])
+        p0 = [r, 100.0]
+    n = 2 * len(g)
+    kf = {'s': np.zeros(n), 'p': np.kron(np.diag(p0), np.eye(2)),
+          'f': np.kron(f1, np.eye(2)), 'q': np.kron(q * np.outer(g, g), np.eye(2)),
+          'h': np.eye(2, n), 'r': r * np.eye(2)}
+    kf['s'][:2] = (x, y)
+    return kf
+
+
+# -------------------------------------------------------------------
+
+def _kalman_predict(kf):
+    """
+    advances Kalman filter by one image
+    :param kf: Kalman filter from _kalman_init, is updated
+    :return: predicted position (x, y), standard deviation of predicted position
+    """
+    kf['s'] = kf['f'] @ kf['s']
+    kf['p'] = kf['f'] @ kf['p'] @ kf['f'].T + kf['q']
+    return kf['s'][:2], np.sqrt(np.diag(kf['p'])[:2])
+
+
+# -------------------------------------------------------------------
+
+def _kalman_update(kf, x, y):
+    """
+    corrects predicted state of Kalman filter with measured position
+    :param kf: Kalman filter from _kalman_init, is updated
+    :param x: measured x-coordinate of line
+    :param y: measured y-coordinate of line
+    """
+    h = kf['h']
+    innovation = np.array([x, y]) - h @ kf['s']
+    gain = kf['p'] @ h.T @ np.linalg.inv(h @ kf['p'] @ h.T + kf['r'])
+    kf['s'] = kf['s'] + gain @ innovation
+    kf['p'] = (np.eye(len(kf['s'])) - gain @ h) @ kf['p']
+
+
+# -------------------------------------------------------------------
+
+def similarity_transforms(table):
+    """
+    calculates for each image the similarity transform which maps the measured line positions
+    to the positions in the first image, x' = a*x - b*y + tx, y' = b*x + a*y + ty,
+    closed form least squares solution for all images at once, only images with all lines found are used
+    with only one line the transform is a translation (a = 1, b = 0)
+    :param table: shift table with rows index, x, y, ..., line number in column 7
+    :return: array with rows index, a, b, tx, ty
+    """
+    frames = np.unique(table[:, 0])
+    lines = table[:, 7].astype(int)
+    pos = np.full((len(frames), lines.max() + 1 if len(lines) else 1, 2), np.nan)
+    pos[np.searchsorted(frames, table[:, 0]), lines] = table[:, 1:3]
+    complete = ~np.isnan(pos).any(axis=(1, 2))
+    frames = frames[complete]
+    pos = pos[complete]
+    if not len(frames):
+        return np.zeros((0, 5))
+    ref = pos[0]
+    if pos.shape[1] == 1:
+        a = np.ones(len(frames))
+        b = np.zeros(len(frames))
+        t = ref - pos[:, 0]
+    else:
+        center = pos.mean(axis=1)
+        p = pos - center[:, None, :]
+        q = ref - ref.mean(axis=0)
+        norm = (p ** 2).sum(axis=(1, 2))
+        a = (p * q).sum(axis=(1, 2)) / norm
+        b = (p[:, :, 0] * q[:, 1] - p[:, :, 1] * q[:, 0]).sum(axis=1) / norm
+        t = ref.mean(axis=0) - np.column_stack([a * center[:, 0] - b * center[:, 1],
+                                                b * center[:, 0] + a * center[:, 1]])
+    return np.column_stack([frames, a, b, t])
+
+
+# -------------------------------------------------------------------
+
+def stack_images(transforms, infile, outfil, fits_dict, dist, window=None, workers=1, contr=1, idg=0, show_reg=False,
+                 write_every=1):
+    """
+    stacking step of register_images, transforms the tracked images to the first image,
+    writes the registered images outfil + 1,2,.. and adds them
+    the images are processed in chunks, with workers > 1 in parallel processes
+    :param transforms: result of similarity_transforms, index, a, b, tx, ty for each image
+    :param infile: full filebase of images e.g. out/mdist
+    :param outfil: filebase of registered files, e.g. out/r
+    :param fits_dict: content of fits-header
+    :param dist: if True, distorted images, else False
+    :param window: GUI window for displaying results, None for use without GUI
+    :param workers: number of processes, 1: no parallel processing
+    :param contr: image contrast for display of registered images
+    :param idg: graph number of displayed image
+    :param show_reg: if True, registered images are displayed
+    :param write_every: write registered images outfil + 1, K+1, 2K+1,.., 0: none
+    :return: sum of registered images
+    """
+    frames = []
+    for n, (index, a, b, tx, ty) in enumerate(transforms):
+        reg_file = outfil + str(n + 1) + '.fit' if write_every and n % write_every == 0 else ''
+        frames.append((infile + str(int(index)), reg_file, (a, b, tx, ty)))
+    workers = max(1, min(workers, len(frames)))
+    # serial: one image per chunk, parallel: two chunks per process for balanced load
+    size = 1 if workers == 1 else -(-len(frames) // (2 * workers))
+    chunks = [frames[k:k + size] for k in range(0, len(frames), size)]
+    sum_image = 0
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_shift_add_images, chunk, fits_dict, dist): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                sum_image = sum_image + future.result()
+                idg = _show_stack_progress(futures[future], window, contr, idg, show_reg)
+    else:
+        for chunk in chunks:
+            sum_image = sum_image + _shift_add_images(chunk, fits_dict, dist)
+            idg = _show_stack_progress(chunk, window, contr, idg, show_reg)
+    return sum_image
+
+
+# -------------------------------------------------------------------
+
+def _shift_add_images(frames, fits_dict, dist):
+    """
+    worker of stack_images, runs in a separate process if workers > 1
+    :param frames: list of (image file, registered image file or '' if not saved, transform (a, b, tx, ty))
+    :param fits_dict: content of fits-header
+    :param dist: if True, distorted images, else False
+    :return: sum of shifted images
+    """
+    sum_image = 0
+    for image_file, reg_file, transform in frames:
+        im, header = get_fits_image(image_file)
+        shifted = _transform_image(im, transform)
+        sum_image = sum_image + shifted
+        if reg_file:
+            write_fits_image(shifted, reg_file, fits_dict, dist=dist)
+    return sum_image
+
+
+# -------------------------------------------------------------------
+
+def _show_stack_progress(chunk, window, contr, idg, show_reg):
+    """
+    displays progress of stack_images in GUI
+    :param chunk: list of processed (image file, registered image file, transform)
+    :return: idg, graph number of displayed image
+    """
+    if window:
+        names = [path.basename(reg_file or image_file) for image_file, reg_file, transform in chunk]
+        info = names[0] if len(names) == 1 else f'{names[0]} - {names[-1]}'
+        window['-RESULT3-'].update(info + ' registered\n', append=True)
+        reg_files = [reg_file for image_file, reg_file, transform in chunk if reg_file]
+        if show_reg and reg_files:
+            image_data, idg, actual_file = draw_scaled_image(reg_files[-1], window['-R_IMAGE-'], opt_dict, idg,
+                                                             contr=contr, resize=True, tmp_image=True)
+            window.set_title('Register: ' + str(actual_file))
+        window.refresh()
+    return idg
+
+
+# -------------------------------------------------------------------
+
+def combine_images(files, method='mean', weights=None, kappa=3.0, max_memory=2 ** 27):
+    """
+    combines images pixel by pixel, the images are read in blocks of rows,
+    so the memory needed does not grow with the number of images beyond max_memory
+    :param files: list of fits-files with extension
+    :param method: 'mean': average,
+                   'median': median,
+                   'clip': sigma clipped average, pixels deviating from the median
+                   by more than kappa * standard deviation are rejected,
+                   'snr': weighted average, for equal noise in the images the weights are
+                   proportional to the signal, e.g. the peak of the registered line
+    :param weights: weights for method 'snr', one for each file
+    :param kappa: rejection threshold of method 'clip'
+    :param max_memory: size of a block of rows of all images in bytes
+    :return: combined image, normalized as from get_fits_image
+    """
+    shapes = set()
+    for file in files:
+        with fits.open(file, memmap=True, do_not_scale_image_data=True) as hdul:
+            shapes.add(hdul[0].shape)
+    if len(shapes) != 1:
+        raise ValueError('images of different size')
+    shape = shapes.pop()
+    if method == 'snr':
+        weights = np.clip(np.asarray(weights, dtype=float), 0, None)
+        if len(weights) != len(files) or weights.sum() <= 0:
+            raise ValueError('no valid weights for snr stacking')
+    rows = shape[-2]
+    row_bytes = 4 * len(files) * int(np.prod(shape)) // rows  # float32 block
+    block = int(np.clip(max_memory // row_bytes, 1, rows))
+    image = None
+    for r0 in range(0, rows, block):
+        cube = np.stack([_read_fits_rows(file, r0, r0 + block) for file in files])
+        part = _combine_block(cube, method, weights, kappa)
+        if image is None:
+            image = np.empty((rows,) + part.shape[1:])
+        image[r0:r0 + block] = part
+    return image
+
+
+# -------------------------------------------------------------------
+
+def _read_fits_rows(file, r0, r1):
+    """
+    reads rows r0:r1 of fits image with memmap, scaled as with get_fits_image
+    :param file: fits-file with extension
+    :param r0: first row
+    :param r1: last row + 1
+    :return: float32 array of rows, for color images with color as last axis
+    """
+    with fits.open(file, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        rows = np.array(hdul[0].data[..., r0:r1, :], dtype=np.float32)
+    scale = header.get('BSCALE', 1)
+    zero = header.get('BZERO', 0)
+    if int(header['BITPIX']) == -32:
+        scale /= 32767
+        zero /= 32767
+    if scale != 1 or zero != 0:
+        rows = rows * np.float32(scale) + np.float32(zero)
+    if len(rows.shape) == 3:
+        rows = np.transpose(rows, (1, 2, 0))
+    return rows
+
+
+# -------------------------------------------------------------------
+
+def _combine_block(cube, method, weights, kappa, iterations=3):
+    """
+    combines block of rows of all images, see combine_images
+    :param cube: array with images along first axis
+    :return: combined rows
+    """
+    if method == 'median':
+        return np.median(cube, axis=0)
+    elif method == 'snr':
+        return np.tensordot(weights, cube, axes=1) / weights.sum()
+    elif method == 'clip':
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # all-nan slices do not occur, median is kept
+            for i in range(iterations):
+                center = np.nanmedian(cube, axis=0)
+                sigma = np.nanstd(cube, axis=0)
+                reject = np.abs(cube - center) > kappa * sigma
+                if not reject.any():
+                    break
+                cube[reject] = np.nan
+            return np.nanmean(cube, axis=0, dtype=np.float64)
+    return np.mean(cube, axis=0, dtype=np.float64)
+
+
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=8)
+def _gaussian_grids(shape):
+    """
+    returns ravelled row and column indices of a rectangle with shape (rows, columns)
+    the grids are cached and computed only once for each size of the selected rectangle
+    """
+    xx, yy = np.indices(shape, dtype=float)
+    xx = xx.ravel()
+    yy = yy.ravel()
+    xx.flags.writeable = False
+    yy.flags.writeable = False
+    return xx, yy
+
+
+# -------------------------------------------------------------------
+
+def _gaussian(p, xx, yy, jacobian=False):
+    """
+    returns the _gaussian function with parameters p at coordinates xx, yy
+    and if required the partial derivatives with respect to the parameters
+    :param p: (height, center_x, center_y, width_x, width_y)
+    :param xx: ravelled row indices from _gaussian_grids
+    :param yy: ravelled column indices from _gaussian_grids
+    :param jacobian: if True, the analytic Jacobian is returned in addition
+    :return: function values, shape (N,)
+    (Jacobian, shape (5, N), as needed by leastsq with col_deriv)
+    """
+    height, center_x, center_y, width_x, width_y = p
+    u = (xx - center_x) / width_x
+    v = (yy - center_y) / width_y
+    e = np.exp(-0.5 * (u * u + v * v))
+    g = height * e
+    if not jacobian:
+        return g
+    jac = np.stack((e, g * u / width_x, g * v / width_y, g * u * u / width_x, g * v * v / width_y), axis=0)
+    return g, jac
 
 
 # -------------------------------------------------------------------
@@ -790,12 +1426,14 @@ def _moments(data):
     height = x = y = width_x = width_y = 0.0
     total = data.sum()
     if total > 0.0:
-        xx, yy = np.indices(data.shape)
-        x = (xx * data).sum() / total
-        y = (yy * data).sum() / total
-        col = data[:, int(y)]
+        xx, yy = _gaussian_grids(data.shape)
+        z = np.ravel(data)
+        x = np.dot(xx, z) / total
+        y = np.dot(yy, z) / total
+        # centroid of noisy or negative data can lie outside the rectangle
+        col = data[:, int(np.clip(y, 0, data.shape[1] - 1))]
         width_x = np.sqrt(np.abs((np.arange(col.size) - y) ** 2 * col).sum() / col.sum())
-        row = data[int(x), :]
+        row = data[int(np.clip(x, 0, data.shape[0] - 1)), :]
         width_y = np.sqrt(np.abs((np.arange(row.size) - x) ** 2 * row).sum() / row.sum())
         height = data.max()
         # print('h: %5.1f'%height,'x: %5.1f'%x, 'y: %5.1f'%y, 'wx: %5.1f'%width_x, 'wy: %5.1f'%width_y)
@@ -807,15 +1445,186 @@ def _moments(data):
 def _fit_gaussian_2d(data):
     """Returns (height, x, y, width_x, width_y)
     the _gaussian parameters of a 2D distribution found by a fit
-    (ravel makes 1-dim array)"""
+    (ravel makes 1-dim array)
+    the coordinate grids are cached for the size of data, the Jacobian is
+    calculated analytically instead of by finite differences"""
     params = _moments(data)
-    success = 0
-    if params[0] > 0:
-        errorfunction = lambda p: np.ravel(_gaussian(*p)(*np.indices(data.shape)) - data)
-    p, success = optimize.leastsq(errorfunction, params)
+    if params[0] <= 0:
+        raise ValueError('no signal in selected rectangle')
+    xx, yy = _gaussian_grids(data.shape)
+    z = np.ravel(data)
+    p, success = optimize.leastsq(lambda q: _gaussian(q, xx, yy) - z, params,
+                                  Dfun=lambda q: _gaussian(q, xx, yy, jacobian=True)[1], col_deriv=1)
     return p, success
 
 
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=8)
+def _phase_correlation_filters(shape):
+    """
+    returns apodization window and low pass filter for phase correlation of
+    rectangles with shape (rows, columns), cached for repeated use with the same shape
+    the Tukey window is flat in the center and does not bias the line position,
+    the Gaussian low pass (sigma = 1 pixel) gives a smooth correlation peak
+    suitable for sub-pixel interpolation
+    """
+
+    def _tukey(n, alpha=0.25):
+        w = np.ones(n)
+        m = int(alpha * (n - 1) / 2)
+        if m > 0:
+            ramp = 0.5 * (1 - np.cos(np.pi * np.arange(m) / m))
+            w[:m] = ramp
+            w[n - m:] = ramp[::-1]
+        return w
+
+    window = np.outer(_tukey(shape[0]), _tukey(shape[1]))
+    fy = fft.fftfreq(shape[0])[:, None]
+    fx = fft.rfftfreq(shape[1])[None, :]
+    low_pass = np.exp(-2 * np.pi ** 2 * (fy ** 2 + fx ** 2))
+    return window, low_pass
+
+
+# -------------------------------------------------------------------
+
+def _phase_correlation_reference(data):
+    """
+    prepares reference for _phase_correlation
+    :param data: reference rectangle
+    :return: complex conjugate of FFT of apodized reference
+    """
+    window, low_pass = _phase_correlation_filters(data.shape)
+    return np.conj(fft.rfft2((data - data.mean()) * window))
+
+
+# -------------------------------------------------------------------
+
+def _phase_correlation(ref_fft, data):
+    """
+    determines shift of data relative to reference by phase correlation
+    the cross power spectrum is normalized by the square root of its amplitude,
+    which is more robust against noise than the pure phase, the sub-pixel position
+    of the correlation peak is found by parabolic interpolation in rows and columns
+    :param ref_fft: reference, from _phase_correlation_reference
+    :param data: rectangle of actual image, same shape as reference
+    :return: shift in rows, shift in columns, correlation peak
+    """
+    window, low_pass = _phase_correlation_filters(data.shape)
+    cross = fft.rfft2((data - data.mean()) * window) * ref_fft
+    amplitude = np.abs(cross)
+    cross *= low_pass / np.sqrt(amplitude + 1.e-3 * np.max(amplitude))
+    corr = fft.irfft2(cross, s=data.shape)
+    (ny, nx) = corr.shape
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+    c0 = corr[iy, ix]
+
+    def _vertex(cm, cp):
+        denominator = cm - 2 * c0 + cp
+        return 0.5 * (cm - cp) / denominator if denominator < 0 else 0.0
+
+    shift_y = iy + _vertex(corr[iy - 1, ix], corr[(iy + 1) % ny, ix])
+    shift_x = ix + _vertex(corr[iy, ix - 1], corr[iy, (ix + 1) % nx])
+    # shifts larger than half the rectangle are negative
+    if shift_y > ny / 2:
+        shift_y -= ny
+    if shift_x > nx / 2:
+        shift_x -= nx
+    return shift_y, shift_x, c0
+
+
+# -------------------------------------------------------------------
+
+def _phase_correlation_shift(ref_fft, imbw, corner, shape, iterations=2):
+    """
+    determines shift of a rectangle of imbw relative to the reference
+    the content at the border of the rectangle, which does not move with the line,
+    biases the phase correlation towards zero shift, therefore the rectangle is
+    shifted by the estimated value and the residual shift is measured again
+    :param ref_fft: reference, from _phase_correlation_reference
+    :param imbw: b/w image
+    :param corner: (row, column) of upper left corner of rectangle
+    :param shape: (rows, columns) of rectangle
+    :param iterations: number of corrections of the estimated shift
+    :return: shift in rows, shift in columns
+    """
+    data = imbw[corner[0]:corner[0] + shape[0], corner[1]:corner[1] + shape[1]]
+    shift_r, shift_c, peak = _phase_correlation(ref_fft, data)
+    for i in range(iterations):
+        data = _shift_rectangle(imbw, corner, shape, [-shift_c, -shift_r])
+        res_r, res_c, peak = _phase_correlation(ref_fft, data)
+        shift_r += res_r
+        shift_c += res_c
+    return shift_r, shift_c
+
+
+# -------------------------------------------------------------------
+
+def _shift_rectangle(imbw, corner, shape, dxy):
+    """
+    returns a rectangle of the image shifted by dxy, only the surrounding
+    of the rectangle is shifted
+    :param imbw: b/w image
+    :param corner: (row, column) of upper left corner of rectangle
+    :param shape: (rows, columns) of rectangle
+    :param dxy: [dx, dy] shift in x (columns) and y (rows)
+    :return: shifted rectangle
+    """
+    m = int(np.max(np.abs(dxy))) + 8  # margin for spline interpolation
+    r0 = max(corner[0] - m, 0)
+    c0 = max(corner[1] - m, 0)
+    region = _shift_image(imbw[r0:corner[0] + shape[0] + m, c0:corner[1] + shape[1] + m], dxy)
+    return region[corner[0] - r0:corner[0] - r0 + shape[0], corner[1] - c0:corner[1] - c0 + shape[1]]
+
+
+# -------------------------------------------------------------------
+
+def _shift_image(im, dxy):
+    """
+    shifts image by dxy with cubic spline interpolation, pixels shifted in from
+    outside the image are set to zero
+    ndimage.shift evaluates the translation row by row, no coordinate grid
+    of the image size is created as with warp_coords and map_coordinates
+    :param im: b/w or color image
+    :param dxy: [dx, dy] shift in x (columns) and y (rows)
+    :return: shifted image
+    """
+    shift = (dxy[1], dxy[0])
+    if len(im.shape) == 3:
+        shifted = np.empty_like(im)
+        for c in range(im.shape[2]):  # separate color planes for faster processing
+            ndimage.shift(im[:, :, c], shift, output=shifted[:, :, c])
+    else:
+        shifted = ndimage.shift(im, shift)
+    return shifted
+
+
+# -------------------------------------------------------------------
+
+def _transform_image(im, transform):
+    """
+    applies similarity transform x' = a*x - b*y + tx, y' = b*x + a*y + ty to image
+    with cubic spline interpolation in one pass, translations are done with _shift_image
+    :param im: b/w or color image
+    :param transform: (a, b, tx, ty)
+    :return: transformed image
+    """
+    a, b, tx, ty = transform
+    if a == 1 and b == 0:
+        return _shift_image(im, (tx, ty))
+    # inverse transform, maps (row, column) of result to (row, column) of im
+    d = a * a + b * b
+    matrix = np.array([[a, -b], [b, a]]) / d
+    offset = np.array([b * tx - a * ty, -a * tx - b * ty]) / d
+    if len(im.shape) == 3:
+        transformed = np.empty_like(im)
+        for c in range(im.shape[2]):
+            ndimage.affine_transform(im[:, :, c], matrix, offset, output=transformed[:, :, c])
+    else:
+        transformed = ndimage.affine_transform(im, matrix, offset)
+    return transformed
+
+
 # -------------------------------------------------------------------
 
 def get_fits_keys(header, fits_dict, res_dict, keyprint=False):
@@ -901,7 +1710,7 @@ def show_fits_image(file, imscale, image_element, contr=1.0, show=True):
 
 # -------------------------------------------------------------------
 
-def select_rectangle(infile, start, res_dict, fits_dict, wloc, outfil, maxim):
+def select_rectangle(infile, start, res_dict, fits_dict, wloc, outfil, maxim, multiple=False):
     """
     displays new window with image infile + start + 'fit
     a rectangle around the selected line can be selected with dragging the mouse
@@ -912,10 +1721,12 @@ def select_rectangle(infile, start, res_dict, fits_dict, wloc, outfil, maxim):
     :param wloc: location of displayed window for selection
     :param outfil:
     :param maxim:
+    :param multiple: if True, several rectangles can be selected, one for each line
     :return:
     Ok if rectangle selected,
     x0, y0: center coordinates of selected rectangle (int)
     dx, dy: half width and height of selected rectangle (int)
+    with multiple lists of x0, y0, dx, dy of the selected rectangles
     """
     im, header = get_fits_image(infile + str(start))
     im = im / np.max(im)
@@ -954,6 +1765,7 @@ def select_rectangle(infile, start, res_dict, fits_dict, wloc, outfil, maxim):
     dragging = False
     start_point = end_point = prior_rect = None
     x0 = y0 = dx = dy = 0
+    rectangles = []
     while winselect_active:
         event, values = winselect.read()
         idg = graph.draw_rectangle((0, 0), (imx, imy), line_color='blue')
@@ -985,14 +1797,180 @@ def select_rectangle(infile, start, res_dict, fits_dict, wloc, outfil, maxim):
                 y0 = xy0[1]
                 dx = int((size[0] + 1) / 2)
                 dy = int((size[1] + 1) / 2)
+                if multiple:
+                    rectangles.append((x0, y0, dx, dy))
+                    info.update(value=f"{len(rectangles)} rectangles, last at {xy0} with size {size}")
+                    prior_rect = None  # keep rectangle
 
         elif event in ('Ok', 'Cancel'):
             graph.delete_figure(idg)
             winselect_active = False
             winselect.close()
+    if multiple:
+        x0, y0, dx, dy = [list(v) for v in zip(*rectangles)] if rectangles else ([], [], [], [])
     return event, x0, y0, dx, dy
 
 
+# -------------------------------------------------------------------
+
+def apply_tilt_slant(im, tilt, slant, y0):
+    """
+    corrects tilt and slant of 2-D spectrum, shifted coordinates:
+        xs = x' - (y'-y0)*slant
+        ys = y' - (xs-x0)*tilt
+        (Pixel value at x',y': I'(x',y') = I(xs,ys) in the original image)
+    the shear is applied as one affine matrix with bilinear interpolation,
+    no coordinate grid is calculated
+    :param im: b/w or color image
+    :param tilt: slope of spectrum (rows per column)
+    :param slant: inclination of spectral lines (columns per row)
+    :param y0: row of spectrum, center of correction together with image center column
+    :return: corrected image
+    """
+    x0 = im.shape[1] / 2
+    # (row, column) of im for (row, column) of corrected image
+    matrix = np.array([[1.0 + slant * tilt, -tilt], [-slant, 1.0]])
+    offset = np.array([(x0 - y0 * slant) * tilt, y0 * slant])
+    if len(im.shape) == 3:
+        imtilt = np.empty_like(im)
+        for c in range(im.shape[2]):
+            ndimage.affine_transform(im[:, :, c], matrix, offset, output=imtilt[:, :, c], order=1)
+    else:
+        imtilt = ndimage.affine_transform(im, matrix, offset, order=1)
+    return imtilt
+
+
+# -------------------------------------------------------------------
+
+def estimate_tilt_slant(im, ymin=0, ymax=0, tilt_range=0.05, slant_range=0.5, steps=9):
+    """
+    finds tilt and slant which give the sharpest spectrum for apply_tilt_slant:
+    tilt maximizes the sum of squares of the vertical profile (columns added),
+    slant maximizes the sum of squares of the spectrum of rows ymin to ymax
+    coarse to fine search on downsampled copies of the image, the range is reduced after
+    each level and the maximum refined by a parabola
+    :param im: b/w or color image
+    :param ymin: first row of spectrum
+    :param ymax: last row of spectrum, 0: all rows
+    :param tilt_range: tilt is searched in +/- tilt_range
+    :param slant_range: slant is searched in +/- slant_range
+    :param steps: number of values per search
+    :return: tilt, slant
+    """
+    imbw = np.sum(im, axis=2) if len(im.shape) == 3 else im
+    imbw = imbw - np.median(imbw)
+    if ymax <= ymin:
+        ymin, ymax = 0, imbw.shape[0]
+    y0 = 0.5 * (ymin + ymax)
+    tilt = slant = 0.0
+    dt, ds = tilt_range, slant_range
+    for factor in (4, 2, 1):
+        if min(imbw.shape) < 16 * factor and factor > 1:
+            continue
+        small = tf.downscale_local_mean(imbw, (factor, factor)) if factor > 1 else imbw
+        # tilt shifts the columns vertically, proportional to the distance from the center column
+        columns = np.fft.rfft(small.T, n=2 * small.shape[0], axis=1)
+        positions = np.arange(small.shape[1]) - 0.5 * small.shape[1]
+        tilt = _search_maximum(lambda t: _shear_sharpness(columns, positions * t), tilt, dt, steps)
+        # slant shifts the rows of the tilt corrected spectrum horizontally
+        r0 = int(ymin / factor)
+        r1 = max(int(np.ceil(ymax / factor)), r0 + 1)
+        band = apply_tilt_slant(small, tilt, 0.0, y0 / factor)[r0:r1]
+        rows = np.fft.rfft(band, n=2 * small.shape[1], axis=1)
+        positions = np.arange(r0, r1) - y0 / factor
+        slant = _search_maximum(lambda s: _shear_sharpness(rows, positions * s), slant, ds, steps)
+        dt /= 0.5 * (steps - 1)
+        ds /= 0.5 * (steps - 1)
+    return tilt, slant
+
+
+# -------------------------------------------------------------------
+
+def _shear_sharpness(spectra, shifts):
+    """
+    sum of squares of the sum of shifted profiles, the shifts are applied with the
+    Fourier shift theorem, so the result is not biased by interpolation
+    :param spectra: rfft of zero padded profiles, one row for each profile
+    :param shifts: shift of each profile in pixel
+    :return: sum of squares in Fourier space (proportional to sum of squares of profile sum)
+    """
+    k = np.fft.rfftfreq(2 * (spectra.shape[1] - 1))
+    total = np.sum(spectra * np.exp(-2j * np.pi * np.outer(shifts, k)), axis=0)
+    return np.sum(np.abs(total) ** 2)
+
+
+# -------------------------------------------------------------------
+
+def _search_maximum(function, center, half_range, steps):
+    """
+    grid search of maximum of function of one variable, refined by parabola through
+    maximum and neighbours
+    :param function: function to maximize
+    :param center: center of search interval
+    :param half_range: search interval center +/- half_range
+    :param steps: number of grid points
+    :return: position of maximum
+    """
+    grid = np.linspace(center - half_range, center + half_range, steps)
+    values = np.array([function(v) for v in grid])
+    i = int(np.argmax(values))
+    if 0 < i < steps - 1:
+        denominator = values[i - 1] - 2 * values[i] + values[i + 1]
+        if denominator < 0:
+            return grid[i] + 0.5 * (values[i - 1] - values[i + 1]) / denominator * (grid[1] - grid[0])
+    return grid[i]
+
+
+# -------------------------------------------------------------------
+
+def optimal_extraction(imbw, ymin, ymax, kappa=5.0, profile_error=0.1, iterations=3):
+    """
+    profile weighted extraction of spectrum (Horne 1986) from rows ymin to ymax
+    the sky background is the median of rows of the same number below and above the band,
+    the cross-dispersion profile is the normalized sum over all columns of the
+    sky subtracted band (spectrum without tilt),
+    pixels deviating from the profile by more than kappa * sigma are rejected
+    (cosmics, hot pixels), variance: sky noise + profile_error of line signal
+    :param imbw: b/w image
+    :param ymin: first row of spectrum
+    :param ymax: last row of spectrum + 1
+    :param kappa: rejection threshold, 0: no rejection
+    :param profile_error: relative deviation of the profile, included in the variance
+    :param iterations: number of iterations for rejection
+    :return: spectrum, sum over profile, comparable to sum of rows minus sky
+    """
+    h = ymax - ymin
+    band = imbw[ymin:ymax, :]
+    sky_rows = np.concatenate([imbw[max(ymin - h, 0):ymin, :], imbw[ymax:ymax + h, :]])
+    if len(sky_rows):
+        sky = np.median(sky_rows, axis=0)
+        residual = sky_rows - sky
+    else:
+        sky = np.zeros(band.shape[1])
+        residual = band - np.median(band, axis=0)
+    var0 = (1.4826 * np.median(np.abs(residual - np.median(residual)))) ** 2 + 1e-20
+    data = band - sky
+    profile = np.clip(np.sum(data, axis=1), 0, None)
+    if np.sum(profile) <= 0:
+        return np.sum(data, axis=0)
+    profile = (profile / np.sum(profile))[:, None]
+    mask = np.ones(data.shape, dtype=bool)
+    spectrum = np.sum(data, axis=0)
+    for i in range(iterations + 1):
+        model = profile * spectrum
+        var = var0 + (profile_error * model) ** 2
+        if kappa and i:
+            # reject worst pixel of each column if outside threshold
+            deviation = np.where(mask, (data - model) ** 2 / var, 0)
+            worst = np.argmax(deviation, axis=0)
+            columns = np.arange(data.shape[1])
+            bad = deviation[worst, columns] > kappa ** 2
+            mask[worst[bad], columns[bad]] = False
+        weights = mask * profile / var
+        spectrum = np.sum(weights * data, axis=0) / np.maximum(np.sum(weights * profile, axis=0), 1e-20)
+    return spectrum
+
+
 # -------------------------------------------------------------------
 
 def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
@@ -1016,19 +1994,6 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
     Ok if selection is accepted
     tilt, slant: selected values for image outfile + ['st.fit', 'st,png']
     """
-
-    def _slant_tilt_mapping(xy, center, dx, dy):
-        """
-        Calculate shifted coordinates:  xs = x' - (y'-y0)*dx (slant)
-                                        ys = y' - (x'-x0)*dy (tilt)
-        (Pixel value at x',y':          I'(x',y') = I(x,y) in the original image)
-        """
-        x, y = xy.T
-        x0, y0 = center
-        xy[..., 0] = x - (y - y0) * dx
-        xy[..., 1] = y - (x - x0) * dy
-        return xy
-
     tilt = 0.0
     slant = 0.0
     ymin = 0
@@ -1043,6 +2008,7 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
         print(np.max(im))
     im = im / np.max(im)
     imtilt = im_ori = im
+    id_preview = None
     fits_dict = get_fits_keys(header, fits_dict, res_dict, keyprint=False)
     write_fits_image(imtilt, outfile + 'st.fit', fits_dict, dist=dist)  # used for calibration, if no tilt, slant
     # new rect_plt
@@ -1064,7 +2030,11 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
     layout_select = [[sg.Text('Start File: ' + outfile, size=(50, 1)),
                       sg.Text('Tilt'), sg.InputText(tilt, size=(8, 1), key='-TILT-'),
                       sg.Text('Slant'), sg.InputText(slant, size=(8, 1), key='-SLANT-'),
+                      sg.Button('Auto', key='-AUTO_TS-', tooltip='estimate tilt and slant for selected rows'),
                       sg.Button('Apply', key='-APPLY_TS-', bind_return_key=True),
+                      sg.Checkbox('optimal extraction', default=False, key='-OPTIMAL-',
+                                  tooltip='profile weighted sum of rows with sky subtraction\n' +
+                                  'and rejection of cosmics, better SNR for faint spectra'),
                       sg.Ok(), sg.Cancel()],
                      image_elem_sel, [sg.Text(key='info', size=(60, 1))]]
     # ---------------------------------------------------------------------------
@@ -1079,6 +2049,9 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
     graph.draw_image(image_file, location=(0, imy)) if image_file else None
     dragging = False
     start_point = end_point = prior_rect = None
+    # preview of tilt and slant at display resolution, full resolution only for Ok
+    (scalex, scaley) = (canvasx / imx, canvasy / imy)
+    im_display = tf.resize(im, (canvasy, canvasx) + im.shape[2:], order=1, mode='reflect')
 
     while winselect_active:
         event, values = winselect.read()
@@ -1107,6 +2080,16 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
             restext += info + '\n'
             window['-RESULT3-'].update(regtext + restext)
 
+        elif event == '-AUTO_TS-':
+            if ymax == 0:
+                sg.PopupError('select rows first', keep_on_top=True)
+            else:
+                tilt_est, slant_est = estimate_tilt_slant(im, ymin, ymax)
+                winselect['-TILT-'].update(f'{tilt_est:.4f}')
+                winselect['-SLANT-'].update(f'{slant_est:.3f}')
+                winselect['info'].update(value=f'estimated tilt = {tilt_est:8.4f}, slant = {slant_est:7.3f}, '
+                                               + 'press Apply')
+
         elif event == '-APPLY_TS-':
             if ymax == 0:
                 sg.PopupError('select rows first', keep_on_top=True)
@@ -1114,13 +2097,8 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
                 try:
                     tilt = float(values['-TILT-'])
                     slant = float(values['-SLANT-'])
-                    image = im
-                    center = (image.shape[1] / 2, y0)
-                    warp_args = {'center': center,
-                                 'dx': slant,
-                                 'dy': tilt}
-                    imtilt = tf.warp(image, _slant_tilt_mapping, map_args=warp_args,
-                                     order=1, mode='constant', cval=0)
+                    preview = apply_tilt_slant(im_display, tilt * scaley / scalex, slant * scalex / scaley,
+                                               y0 * scaley)
                     fits_dict['M_TILT'] = str(tilt)
                     fits_dict['M_SLANT'] = str(slant)
                     fits_dict['M_ROWMIN'] = str(ymin)
@@ -1132,14 +2110,20 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
                 except:
                     sg.PopupError('bad values for tilt or slant, try again',
                                   keep_on_top=True)
-                write_fits_image(imtilt, '_st.fit', fits_dict, dist=dist)
-                image_data, idg, actual_file = draw_scaled_image('_st' + '.fit', window['-R_IMAGE-'],
-                                                                 opt_dict, idg, contr=contr, tmp_image=True)
-                graph.draw_image(data=image_data, location=(0, imy))
+                    preview = im_display
+                image_data = _image_to_png(preview, contr)
+                idg = refresh_image(image_data, window['-R_IMAGE-'], opt_dict, idg)
+                if id_preview:
+                    graph.delete_figure(id_preview)
+                id_preview = graph.draw_image(data=image_data, location=(0, imy))
                 graph.draw_rectangle((0, ymin), (imx, ymax), line_color='red')
                 graph.update()
 
         elif event == 'Ok':
+            if tilt or slant:
+                imtilt = apply_tilt_slant(im, tilt, slant, y0)
+            fits_dict['M_ROWMIN'] = str(ymin)  # rows also without tilt and slant, used for spectral_cube
+            fits_dict['M_ROWMAX'] = str(ymax)
             write_fits_image(imtilt, outfile + 'st.fit', fits_dict, dist=dist)
             image_data, idg, actual_file = draw_scaled_image(outfile + 'st.fit', window['-R_IMAGE-'],
                                                              opt_dict, idg, contr=contr, tmp_image=True)
@@ -1156,7 +2140,11 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
                 imbw = np.sum(imtilt, axis=2)
             else:
                 imbw = imtilt
-            row_sum = np.sum(imbw[ymin:ymax, :], axis=0)  # Object spectrum extraction and flat
+            if values['-OPTIMAL-'] and ymax > ymin:
+                row_sum = optimal_extraction(imbw, ymin, ymax)
+                logging.info('optimal extraction')
+            else:
+                row_sum = np.sum(imbw[ymin:ymax, :], axis=0)  # Object spectrum extraction and flat
             i = np.arange(0, np.size(row_sum), 1)  # create pixels vector
             np.savetxt(outfile + '.dat', np.transpose([i, row_sum]), fmt='%6i %8.5f')
             fits_dict.pop('M_TILT', None)
@@ -1167,6 +2155,7 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
             # if idg: graph.delete_figure(idg)
             winselect.close()
             window['-SAVE_RAW-'].update(disabled=False, button_color=bc_enabled)
+            window['-CUBE-'].update(disabled=False, button_color=bc_enabled)
             window['-CAL_R-'].update(disabled=False, button_color=bc_enabled)
             window['-RADD-'].update(outfile)
 
@@ -1178,11 +2167,144 @@ def add_rows_apply_tilt_slant(outfile, par_dict, res_dict, fits_dict, opt_dict,
     return event, tilt, slant
 
 
+# -------------------------------------------------------------------
+
+def spectral_cube(outfil, nim, tilt, slant, ymin, ymax, chunk=16):
+    """
+    extracts the spectrum of each registered image saved by the last registration with the tilt, slant
+    and rows of the sum image, see apply_tilt_slant
+    the registered images and the indices of the source images are taken from outfil + '_transform.txt',
+    stale registered images of earlier runs and images not saved (write_every > 1) are not used
+    the coordinates of the corrected rows are calculated once, only the rows needed are read
+    and a chunk of images is interpolated with one call of map_coordinates
+    :param outfil: filebase of registered images, e.g. out/r
+    :param nim: number of added images of the sum image (M_NIM), checked with the transform table,
+                0: not checked
+    :param tilt: tilt of sum image
+    :param slant: slant of sum image
+    :param ymin: first row of spectrum
+    :param ymax: last row of spectrum + 1
+    :param chunk: number of images interpolated together
+    :return: cube: array (number of images, number of pixels), sum of rows for each image
+             frames: indices of the source images used
+    """
+    transforms = np.loadtxt(outfil + '_transform.txt', ndmin=2)
+    if nim and len(transforms) != nim:
+        raise ValueError(f'{outfil}_transform.txt has {len(transforms)} images, sum image {nim}, register again')
+    if transforms.shape[1] > 5:
+        transforms = transforms[transforms[:, 5] > 0]
+        reg_files = [outfil + str(int(n)) + '.fit' for n in transforms[:, 5]]
+    else:
+        # table without file numbers, all registered images saved
+        reg_files = [outfil + str(n + 1) + '.fit' for n in range(len(transforms))]
+    frames = transforms[:, 0].astype(int)
+    if not reg_files:
+        raise FileNotFoundError(f'no registered images saved for {outfil}_transform.txt, set write every > 0')
+    missing = [file for file in reg_files if not path.exists(file)]
+    if missing:
+        raise FileNotFoundError(f'registered image {missing[0]} missing, register again')
+    with fits.open(reg_files[0], memmap=True, do_not_scale_image_data=True) as hdul:
+        (imy, imx) = hdul[0].shape[-2:]
+    x0 = imx / 2
+    y0 = int(0.5 * (ymin + ymax))
+    rows, columns = np.mgrid[ymin:ymax, 0:imx].astype(float)
+    xs = columns - (rows - y0) * slant
+    ys = rows - (xs - x0) * tilt
+    r0 = int(np.clip(np.floor(ys.min()), 0, imy - 1))
+    r1 = int(np.clip(np.ceil(ys.max()) + 2, r0 + 1, imy))
+    cube = np.zeros((len(frames), imx))
+    for k in range(0, len(frames), chunk):
+        files = reg_files[k:k + chunk]
+        stack = []
+        for file in files:
+            im = _read_fits_rows(file, r0, r1)
+            stack.append(np.sum(im, axis=2) if len(im.shape) == 3 else im)
+        stack = np.array(stack)
+        index = np.broadcast_to(np.arange(len(files), dtype=float)[:, None, None], (len(files),) + xs.shape)
+        band = ndimage.map_coordinates(stack, [index, np.broadcast_to(ys - r0, index.shape),
+                                               np.broadcast_to(xs, index.shape)], order=1, mode='constant')
+        cube[k:k + len(files)] = np.sum(band, axis=1)
+    return cube, frames
+
+
+# -------------------------------------------------------------------
+
+def line_light_curves(cube, lines=None, n_lines=5, width=3):
+    """
+    light curves of emission lines from spectral cube
+    flux of a line: sum of pixels x - width .. x + width minus continuum,
+    the continuum is the median of the pixels up to 2 * width on both sides
+    :param cube: array (number of images, number of pixels) from spectral_cube
+    :param lines: list of (name, pixel), None: the n_lines strongest peaks of the summed spectrum,
+                  with prominence above 10 times the noise
+    :param n_lines: number of lines found automatically
+    :param width: half width of line window in pixel
+    :return: list of (name, pixel, light curve)
+    """
+    if lines is None:
+        spectrum = np.sum(cube, axis=0)
+        noise = 1.4826 * np.median(np.abs(np.diff(spectrum) - np.median(np.diff(spectrum)))) / np.sqrt(2)
+        peaks, properties = signal.find_peaks(spectrum, prominence=10 * noise, distance=2 * width + 1)
+        strongest = peaks[np.argsort(properties['prominences'])[::-1][:n_lines]]
+        lines = [(f'X{x}', x) for x in sorted(strongest)]
+    curves = []
+    npix = cube.shape[1]
+    for name, x in lines:
+        x = int(round(x))
+        line = cube[:, max(x - width, 0):min(x + width + 1, npix)]
+        side = np.concatenate([cube[:, max(x - 3 * width, 0):max(x - width, 0)],
+                               cube[:, min(x + width + 1, npix):min(x + 3 * width + 1, npix)]], axis=1)
+        continuum = np.median(side, axis=1) if side.shape[1] else 0
+        curves.append((name, x, np.sum(line, axis=1) - line.shape[1] * continuum))
+    return curves
+
+
+# -------------------------------------------------------------------
+
+def save_spectral_cube(outfile, outfil, fits_dict, lines=None):
+    """
+    writes spectral cube and light curves of the registered images for the sum image outfile
+    tilt, slant and rows are read from the header of outfile + 'st.fit' (saved by add_rows_apply_tilt_slant)
+    output outfile + '_cube.fit': primary image: cube (image, pixel),
+    table extension LIGHTCURVES: column FRAME (index of source image) and one column for each line
+    :param outfile: sum image, e.g. out/r_add30
+    :param outfil: filebase of registered images, e.g. out/r
+    :param fits_dict: content of fits-header
+    :param lines: list of (name, pixel), None: strongest lines, see line_light_curves
+    :return: filename of cube, list of (name, pixel, light curve)
+    """
+    header = fits.getheader(outfile + 'st.fit')
+    if 'M_ROWMIN' not in header:
+        raise ValueError(f'no rows selected in {outfile}st.fit, use Add Rows first')
+    tilt = float(header.get('M_TILT', 0))
+    slant = float(header.get('M_SLANT', 0))
+    ymin = int(header['M_ROWMIN'])
+    ymax = int(header['M_ROWMAX'])
+    nim = int(header.get('M_NIM', fits_dict.get('M_NIM', 0)))
+    cube, frames = spectral_cube(outfil, nim, tilt, slant, ymin, ymax)
+    curves = line_light_curves(cube, lines)
+    cube_dict = dict(fits_dict)
+    cube_dict.setdefault('COMMENT', '')
+    cube_dict.update({'M_TILT': str(tilt), 'M_SLANT': str(slant), 'M_ROWMIN': str(ymin), 'M_ROWMAX': str(ymax)})
+    cube_file = outfile + '_cube.fit'
+    write_fits_image(cube, cube_file, cube_dict, dist=False)
+    columns = [fits.Column(name='FRAME', format='J', array=frames)]
+    columns += [fits.Column(name=name, format='E', array=curve) for name, x, curve in curves]
+    table = fits.BinTableHDU.from_columns(columns, name='LIGHTCURVES')
+    for k, (name, x, curve) in enumerate(curves):
+        table.header[f'PIXEL{k + 1}'] = (x, f'pixel of line {name}')
+    with fits.open(cube_file, mode='append') as hdul:
+        hdul.append(table)
+    return cube_file, curves
+
+
 # -------------------------------------------------------------------
 
 def select_calibration_line(x0, w, lam, name, lcal, ical, graph, table, caltext):
     """
-    fits a parabola to peak of selected line, determines peak position, intensity and width
+    interpolates peak of selected line (see peak_interpolation), determines peak position and width
+    the center of a flat top (saturated line) is the middle of the plateau as in signal.find_peaks,
+    for saturated lines a Gaussian is fitted to the unsaturated points on both sides of the plateau
     results are appended to table together with wavelength of selected line
     :param x0: peak position in pixel
     :param w:
@@ -1194,20 +2316,18 @@ def select_calibration_line(x0, w, lam, name, lcal, ical, graph, table, caltext)
     :param table: table with calibration results
     :param caltext: multiline info
     :return:
-    coeff[1]: peak position of parabolic fit
+    x0p: sub-pixel peak position
     fwp: peak width (approximate)
     caltext: updated info
     """
 
-    def parab(x, *p):
-        aa, mu, b = p
-        return aa * (1 - b * (x - mu) ** 2)
+    def gauss(x, *p):
+        aa, mu, fw = p
+        return base + aa * np.exp(-4 * np.log(2) * ((x - mu) / fw) ** 2)
 
-    coeff = [-1, 0, 0]
+    x0p = 0
     fwp = 0
     lmin = lcal[0]
-    ic = lcal
-    lc = ical
     icleft = int(x0 - w)  # index of left border
     icright = int(x0 + w + 1)
     if lmin not in (0.0, 1.0):
@@ -1215,37 +2335,196 @@ def select_calibration_line(x0, w, lam, name, lcal, ical, graph, table, caltext)
                       line_width=60)
     else:
         try:
-            lcr0 = lc[icleft:icright]
-            lmax0 = np.max(lcr0)
-            for i in range(icright - icleft):
-                if (lcr0[i] - lmax0 + 1.e-5) > 0:
-                    m = i
-            peak0 = icleft + m  # index of max value, center for parabolic fit
-            icr = ic[peak0 - 2:peak0 + 3]
-            lcr = lc[peak0 - 2:peak0 + 3]
-            coeff[0] = lmax0
-            coeff[1] = peak0
-            coeff[2] = 1 / (w + 1)
-            coeff, var_matrix = optimize.curve_fit(parab, icr, lcr, p0=coeff)
-            # lcp_fit = parab(icr, *coeff) # function for display results
-            x0p = coeff[1]
-            fwp = np.sqrt(1.5 / coeff[2])
-            # parabolic fit
+            lcr0 = ical[icleft:icright]
+            left = np.argmax(lcr0)  # plateau of max value, center for interpolation
+            right = left
+            while right + 1 < len(lcr0) and lcr0[right + 1] == lcr0[left]:
+                right += 1
+            peak0 = icleft + (left + right) // 2
+            base = np.min(lcr0)
+            if right > left:
+                # saturated line, fit to 3 points on both sides of the plateau
+                i0 = max(icleft + left - 3, 0)
+                xs = np.r_[lcal[i0:icleft + left], lcal[icleft + right + 1:icleft + right + 4]]
+                ys = np.r_[ical[i0:icleft + left], ical[icleft + right + 1:icleft + right + 4]]
+                coeff, var_matrix = optimize.curve_fit(gauss, xs, ys, p0=[2 * (lcr0[left] - base),
+                                                       lcal[icleft] + 0.5 * (left + right), right - left + 2])
+                x0p = coeff[1]
+                fwp = abs(coeff[2])
+                xp = np.linspace(xs[0], xs[-1], 25)
+                yp = np.minimum(gauss(xp, *coeff), lcr0[left])
+            else:
+                xp = lcal[peak0 - 2:peak0 + 3]
+                dx, height, fwhm = peak_interpolation(ical, np.array([peak0]), base)
+                x0p = lcal[peak0] + dx[0]
+                fwp = fwhm[0]
+                yp = base + height[0] * np.exp(-4 * np.log(2) * ((xp - x0p) / fwp) ** 2)
+            if not (np.isfinite(x0p) and np.isfinite(fwp)) or abs(x0p - lcal[peak0]) > 0.5 * (right - left) + 1:
+                raise ValueError
             if debug:
                 print(f'x0p ={x0p:8.2f} FWHMP={fwp:8.3f}')
-            points = []
-            l0: int
-            for l0 in range(peak0 - 2, peak0 + 3):
-                points.append((lcal[l0], parab(lcal[l0], *coeff)))
-            for l0 in range(1, 5):
-                graph.DrawLine(points[l0 - 1], points[l0], 'blue', 1)
-            table.append((coeff[1], lam))
-            info = f'{coeff[1]:8.2f} {fwp:6.2f} {lam:8.2f} {name}'
+            # fitted profile, drawn as one polyline
+            graph.DrawLines(list(zip(xp, yp)), 'blue', 1)
+            table.append((x0p, lam))
+            info = f'{x0p:8.2f} {fwp:6.2f} {lam:8.2f} {name}'
             caltext += info + '\n'
             logging.info(info)
         except:
             sg.PopupError('Select Line: no peak found, try again', title='Select line')
-    return coeff[1], fwp, caltext
+    return x0p, fwp, caltext
+
+
+# -------------------------------------------------------------------
+
+def peak_interpolation(ical, ip, base=0.0, method='gauss'):
+    """
+    closed-form sub-pixel interpolation of peaks from 3 points around each maximum
+    method 'gauss' fits a parabola to the logarithm of the intensities, where this is
+    not possible (values below base) the parabolic interpolation is used,
+    for a flat top (no curvature) dx = 0, the height of the plateau and the FWHM from signal.peak_widths
+    are returned
+    :param ical: intensity array
+    :param ip: array of indices of local maxima, 0 < ip < len(ical) - 1
+    :param base: baseline, scalar or array with one value per peak
+    :param method: 'gauss' or 'parabola'
+    :return: dx: offset of peak to ip in pixel
+             height: peak height above base
+             fwhm: full width at half maximum in pixel
+    """
+    ical = np.asarray(ical, dtype=float)
+    y0, y1, y2 = (ical[ip - 1] - base, ical[ip] - base, ical[ip + 1] - base)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = y0 - 2 * y1 + y2
+        dx = 0.5 * (y0 - y2) / d
+        height = y1 - 0.25 * (y0 - y2) * dx
+        fwhm = 2 * np.sqrt(-height / d)
+        if method == 'gauss':
+            valid = np.minimum(np.minimum(y0, y1), y2) > 0
+            l0, l1, l2 = (np.log(np.where(valid, y, 1)) for y in (y0, y1, y2))
+            dl = l0 - 2 * l1 + l2
+            valid &= dl < 0
+            dxg = 0.5 * (l0 - l2) / dl
+            dx = np.where(valid, dxg, dx)
+            height = np.where(valid, np.exp(l1 - 0.25 * (l0 - l2) * dxg), height)
+            fwhm = np.where(valid, 2 * np.sqrt(-2 * np.log(2) / dl), fwhm)
+    flat = ~(d < 0)  # no maximum, e.g. flat top of saturated line
+    if np.any(flat):
+        dx = np.where(flat, 0.0, dx)
+        height = np.where(flat, y1, height)
+        fwhm = np.array(fwhm, dtype=float)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # prominence 0 for indices which are not peaks
+            fwhm[flat] = signal.peak_widths(ical, np.atleast_1d(ip)[flat], rel_height=0.5)[0]
+    return dx, height, fwhm
+
+
+# -------------------------------------------------------------------
+
+def find_spectral_peaks(lcal, ical, snr=5.0, max_peaks=30, method='gauss'):
+    """
+    detects all significant peaks of a raw spectrum in one pass
+    the noise is estimated from the median absolute difference of neighbouring pixels,
+    peaks with a prominence above snr * noise are kept, the strongest max_peaks are returned
+    :param lcal: pixel array
+    :param ical: intensity array
+    :param snr: minimum prominence in units of the noise
+    :param max_peaks: maximum number of peaks returned
+    :param method: sub-pixel interpolation, 'gauss' or 'parabola', see peak_interpolation
+    :return: x: sub-pixel peak positions (in units of lcal), sorted
+             height: peak height above local baseline
+             fwhm: peak widths in pixel
+             peak_snr: signal to noise ratio of peaks
+    """
+    ical = np.asarray(ical, dtype=float)
+    noise = 1.4826 * np.median(np.abs(np.diff(ical))) / np.sqrt(2) + 1.e-10
+    ip, props = signal.find_peaks(ical, prominence=snr * noise)
+    keep = np.sort(np.argsort(props['prominences'])[::-1][:max_peaks])
+    ip = ip[keep]
+    base = ical[ip] - props['prominences'][keep]
+    dx, height, fwhm = peak_interpolation(ical, ip, base, method=method)
+    finite = np.isfinite(dx) & np.isfinite(height) & np.isfinite(fwhm)
+    (ip, dx, height, fwhm) = (ip[finite], np.clip(dx[finite], -1, 1), height[finite], fwhm[finite])
+    x = lcal[0] + ip + dx
+    return x, height, fwhm, height / noise
+
+
+# -------------------------------------------------------------------
+
+def identify_calibration_lines(lcal, ical, m_linelist, disp0, disp_tol=0.2, tol=3.0, snr=5.0,
+                               max_peaks=25, max_pairs=15, deg=1):
+    """
+    identifies calibration lines automatically
+    all peaks of the raw spectrum are matched to the lines of m_linelist (all orders)
+    every pair of strong peaks and pair of lines defines a linear dispersion
+    lambda = a + b * x, hypotheses with b within disp_tol of disp0 are scored by the number
+    of lines with a peak within tol pixel, the best one is refined by a polynomial fit of degree deg
+    :param lcal: pixel array
+    :param ical: intensity array
+    :param m_linelist: filename of line list without extension
+    :param disp0: approximate dispersion [nm/pixel], e.g. D_DISP0 of the header
+    :param disp_tol: relative tolerance of dispersion
+    :param tol: max. distance [pixel] of peak and predicted line position
+    :param snr: detection threshold of peaks, see find_spectral_peaks
+    :param max_peaks: number of peaks used for matching
+    :param max_pairs: number of strongest peaks used for generating hypotheses
+    :param deg: degree of polynomial for refinement, as selected for the calibration
+    :return: table: list of (pixel, lambda) as used by select_calibration_line
+             caltext: multiline info
+    """
+    table = []
+    caltext = ''
+    try:
+        catalog = line_catalog(m_linelist)
+    except FileNotFoundError:
+        return table, caltext
+    lam = catalog['lam']
+    names = catalog['names']
+    if len(lam) < 2 or not disp0:
+        return table, caltext
+    x, height, fwhm, peak_snr = find_spectral_peaks(lcal, ical, snr=snr, max_peaks=max_peaks)
+    if len(x) < 2:
+        return table, caltext
+    # hypotheses from pairs of strongest peaks and pairs of lines
+    strong = np.sort(np.argsort(np.nan_to_num(height, nan=-np.inf))[::-1][:max_pairs])
+    i, j = np.triu_indices(len(strong), 1)
+    k, m = np.nonzero(~np.eye(len(lam), dtype=bool))
+    xi = x[strong[i]][:, None]
+    xj = x[strong[j]][:, None]
+    b = (lam[m] - lam[k])[None, :] / (xj - xi)
+    a = lam[k][None, :] - b * xi
+    valid = np.abs(b / disp0 - 1) < disp_tol
+    a = a[valid]
+    b = b[valid]
+    if not len(b):
+        return table, caltext
+    # score: soft count of lines with a peak close to the predicted position
+    xp = (lam[None, :] - a[:, None]) / b[:, None]
+    n = np.clip(np.searchsorted(x, xp), 1, len(x) - 1)
+    dist = np.minimum(np.abs(xp - x[n - 1]), np.abs(xp - x[n]))
+    score = np.sum(np.clip(1 - dist / tol, 0, None), axis=1)
+    best = np.argmax(score)
+    c = [b[best], a[best]]
+    for fit_deg in (1, 1, deg, deg):
+        # assign each line to the nearest peak (distance in pixel), each peak to at most one line
+        dist = np.abs(np.polyval(c, x)[None, :] - lam[:, None]) / abs(disp0)
+        n = np.argmin(dist, axis=1)
+        d = dist[np.arange(len(lam)), n]
+        pairs = {}
+        for line in np.argsort(d):
+            if d[line] < tol and n[line] not in pairs:
+                pairs[n[line]] = line
+        if len(pairs) <= fit_deg + 1:
+            break
+        ip = np.array(sorted(pairs))
+        il = np.array([pairs[p] for p in ip])
+        c = np.polyfit(x[ip], lam[il], fit_deg)
+    for p in sorted(pairs):
+        line = pairs[p]
+        table.append((x[p], lam[line]))
+        info = f'{x[p]:8.2f} {fwhm[p]:6.2f} {lam[line]:8.2f} {names[line]}'
+        caltext += info + '\n'
+        logging.info(info)
+    return table, caltext
 
 
 # -------------------------------------------------------------------
@@ -1256,28 +2535,101 @@ def create_line_list_combo(m_linelist, window, combo=True):
     :param m_linelist: table with wavelength, line identifier (space separated)
     :param window: Combobox for selecting wavelength
     :param combo: if True: update Combo, else only create list
-    :return: label_str
+    :return: label_str, lam_calib: list of (wavelength, identifier), list of lines
     """
+    label_str = []
+    lam_calib = []
     try:
-        lam_calib = []
-        label_str = []
-        i = -1
-        with open(m_linelist + '.txt')as f:
-            for x in f:
-                x = x.lstrip()
-                (l, name) = x.split(' ', 1)
-                i += 1
-                lam_calib.append(x)
-                label_str.append((float(l), name))
-                if abs(float(l)) < 0.1:
-                    index0 = i  # set default index for list
+        catalog = line_catalog(m_linelist)
+        lam_calib = catalog['text']
+        label_str = list(zip(catalog['lam'], catalog['names']))
         if combo:
+            # set default index for list to the line closest to zero order
+            index0 = int(np.argmin(np.abs(catalog['lam']))) if lam_calib else 0
             window['-LAMBDA-'].update(values=lam_calib, set_to_index=index0)
     except FileNotFoundError:
         sg.PopupError(f'no calibration lines {m_linelist}.txt found, use default')
     return label_str, lam_calib
 
 
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=8)
+def _read_line_catalog(filename, mtime):
+    """
+    parses line list, cached until the modification time of the file changes
+    the wavelengths are returned also as written in the file, for the text of the lines
+    """
+    lam = []
+    names = []
+    lam_text = []
+    with open(filename) as f:
+        for x in f:
+            x = x.strip()
+            if x and not x.startswith('#'):
+                (l, name) = (x.split(None, 1) + [''])[:2]
+                lam.append(float(l))
+                names.append(name.strip())
+                lam_text.append(l)
+    return np.array(lam), tuple(names), tuple(lam_text)
+
+
+# -------------------------------------------------------------------
+
+def line_catalog(catalogs='m_linelist', orders=None):
+    """
+    line catalogue as arrays sorted by wavelength for fast lookup, see nearest_lines
+    lines: wavelength [nm] (negative for negative orders), space, identifier
+    :param catalogs: filename of line list (with or without extension .txt) or list of line lists
+    :param orders: None: lines as listed, otherwise tuple of orders, e.g. (-1, 0, 1, 2),
+                   the positive wavelengths are multiplied by each order (0: zero order)
+    :return: catalog: dictionary with lam (sorted array), names, text ('lambda identifier'),
+             lambda in text as written in the line list (first order) or with 10 significant digits
+    """
+    if isinstance(catalogs, str):
+        catalogs = [catalogs]
+    lam = [np.zeros(0)]
+    names = []
+    lam_text = []
+    for catalog in catalogs:
+        filename = catalog if catalog.endswith('.txt') else catalog + '.txt'
+        lam_cat, names_cat, text_cat = _read_line_catalog(filename, os.stat(filename).st_mtime_ns)
+        lam.append(lam_cat)
+        names += names_cat
+        lam_text += text_cat
+    lam = np.concatenate(lam)
+    if orders:
+        first = lam > 0
+        lam_first = lam[first]
+        names_first = [name for name, f in zip(names, first) if f]
+        text_first = [t for t, f in zip(lam_text, first) if f]
+        lam = np.concatenate([lam_first * m for m in orders if m] + [np.zeros(1 if 0 in orders else 0)])
+        names = names_first * len([m for m in orders if m]) + (['zero'] if 0 in orders else [])
+        lam_text = sum([text_first if m == 1 else [f'{v:.10g}' for v in lam_first * m] for m in orders if m],
+                       []) + (['0'] if 0 in orders else [])
+    order = np.argsort(lam, kind='stable')
+    # lines contained in several catalogues or orders are kept once
+    keep = [k for n, k in enumerate(order)
+            if not n or lam[k] != lam[order[n - 1]] or names[k] != names[order[n - 1]]]
+    return {'lam': lam[keep], 'names': [names[k] for k in keep], 'text': [f'{lam_text[k]} {names[k]}' for k in keep]}
+
+
+# -------------------------------------------------------------------
+
+def nearest_lines(catalog, x):
+    """
+    indices of the catalogue lines closest to the wavelengths x (binary search)
+    :param catalog: see line_catalog
+    :param x: wavelength or array of wavelengths
+    :return: index or array of indices into catalog['lam']
+    """
+    lam = catalog['lam']
+    if len(lam) < 2:
+        return np.zeros(np.shape(x), dtype=int)
+    i = np.clip(np.searchsorted(lam, x), 1, len(lam) - 1)
+    return np.where(np.abs(x - lam[i - 1]) <= np.abs(lam[i] - x), i - 1, i)
+
+
 # -------------------------------------------------------------------
 
 
@@ -1297,16 +2649,19 @@ def read_video_list(file):
 
 # -------------------------------------------------------------------
 
-def calibrate_raw_spectrum(rawspec, xcalib, lcalib, deg, c):
+def calibrate_raw_spectrum(rawspec, xcalib, lcalib, deg, c, rebin='quadratic', response=None):
     """
     calculates the fit for the calibration table with residuals
     from the polynomial fit
     and apply those to the pixels vector
+    the wavelength solution is saved with extension cal.ini for use with calibrate_raw_spectra
     :param rawspec: uncalibrated spectrum
     :param xcalib: measured pixel positions
     :param lcalib: calibration wavelengths
     :param deg: degree of fit polynom
     :param c: fit polynom
+    :param rebin: resampling of cal2.dat, see apply_wavelength_solution
+    :param response: instrument response (lresp, resp), see build_response, None: no correction
     :return:
     caldat: calibrated spectrum with extension .dat
     cal2dat: calibrated spectrum with constant wavelength spacing with extension .dat
@@ -1314,36 +2669,503 @@ def calibrate_raw_spectrum(rawspec, xcalib, lcalib, deg, c):
     caltext: calibration info
     """
     np.set_printoptions(precision=4, suppress=False)
-    lcal, ical = np.loadtxt(rawspec, unpack=True, ndmin=2)
     logging.info(f'polynom for fit lambda c: {c}')
-    i = np.arange(0, len(lcal), 1)  # create pixels vector for uncalibrated image
-    lam = np.poly1d(c)(i)
-    res = np.poly1d(c)(xcalib) - lcalib
-    rms_x = np.sqrt(np.average(np.square(res)))
+    solution = wavelength_solution(xcalib, lcalib, deg, c, table=change_extension(rawspec, '.txt'))
+    res = np.polyval(c, xcalib) - lcalib
+    rms_x = solution['rms']
     logging.info('    pixel     lambda      fit        error')
     caltext = '   Pixel     lambda        fit    error\n'
     for i in range(0, len(xcalib)):
         logging.info(f'{xcalib[i]:10.2f},{lcalib[i]:10.2f},{(lcalib[i] + res[i]):10.2f}, {res[i]:10.4f}')
         caltext += f'{xcalib[i]:9.2f} {lcalib[i]:9.2f} {(lcalib[i] + res[i]):9.2f}  {res[i]:8.2f}\n'
     logging.info(f'rms_x = {rms_x:8.4f}')
+    caldat, cal2dat, lmin, lmax = apply_wavelength_solution(rawspec, solution, rebin=rebin, response=response)
+    write_wavelength_solution(change_extension(rawspec, 'cal.ini'), solution)
+    caltext += f'polynom degree: {deg}\npolynom for fit lambda c: {c}\n'
+    caltext += f'rms_x = {rms_x:8.4f}\nspectrum {caldat} saved\n'
+    return caldat, cal2dat, lmin, lmax, caltext
+
+
+# -------------------------------------------------------------------
+
+def wavelength_solution(xcalib, lcalib, deg, c, table=''):
+    """
+    collects the wavelength calibration in a dictionary
+    :param xcalib: measured pixel positions
+    :param lcalib: calibration wavelengths
+    :param deg: degree of fit polynom
+    :param c: fit polynom, highest power first
+    :param table: filename of calibration table
+    :return: solution: dictionary with keys c, deg, rms, table
+    """
+    c = [float(ci) for ci in c]
+    res = np.polyval(c, np.atleast_1d(xcalib)) - np.atleast_1d(lcalib)
+    rms = float(np.sqrt(np.average(np.square(res))))
+    return {'c': c, 'deg': int(deg), 'rms': rms, 'table': table}
+
+
+# -------------------------------------------------------------------
+
+def write_wavelength_solution(filename, solution):
+    """
+    saves wavelength solution as ini-file
+    :param filename: filename with extension .ini
+    :param solution: dictionary, see wavelength_solution
+    :return: None
+    """
+    config = configparser.ConfigParser()
+    config.add_section('Wavelength')
+    config.set('Wavelength', 'c', ' '.join(f'{ci:.10g}' for ci in solution['c']))
+    config.set('Wavelength', 'deg', str(solution['deg']))
+    config.set('Wavelength', 'rms', f'{solution["rms"]:.6g}')
+    config.set('Wavelength', 'table', solution['table'])
+    with open(filename, 'w') as cfgfile:
+        config.write(cfgfile)
+    logging.info(f'wavelength solution saved as {filename}')
+
+
+# -------------------------------------------------------------------
+
+def read_wavelength_solution(filename):
+    """
+    reads wavelength solution saved with write_wavelength_solution
+    :param filename: filename with extension .ini
+    :return: solution: dictionary, see wavelength_solution
+    raises FileNotFoundError, ValueError for invalid files, KeyError if the section or a value is missing
+    """
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(filename):
+            raise FileNotFoundError(filename)
+    except configparser.Error as e:
+        raise ValueError(f'{filename} is no wavelength solution: {e}')
+    section = config['Wavelength']
+    return {'c': [float(ci) for ci in section['c'].split()], 'deg': int(section['deg']),
+            'rms': float(section['rms']), 'table': section.get('table', '')}
+
+
+# -------------------------------------------------------------------
+
+def apply_wavelength_solution(rawspec, solution, rebin='quadratic', response=None):
+    """
+    applies wavelength solution to raw spectrum, the polynom is evaluated for all pixels at once
+    :param rawspec: uncalibrated spectrum
+    :param solution: dictionary, see wavelength_solution
+    :param rebin: resampling of cal2.dat, 'flux' conserves the integrated line flux,
+                  otherwise kind of resample_spectrum
+    :param response: instrument response (lresp, resp), see build_response, None: no correction
+    :return:
+    caldat: calibrated spectrum with extension .dat
+    cal2dat: calibrated spectrum with constant wavelength spacing with extension .dat
+    lmin, lmax: wavelength range of calibrated spectrum
+    """
+    c = solution['c']
+    deg = solution['deg']
+    lcal, ical = load_spectrum(rawspec)
+    lam = np.polyval(c, np.arange(len(lcal)))  # pixels vector for uncalibrated image
+    if response is not None:
+        ical = apply_response(lam, ical, response)
     caldat = change_extension(rawspec, 'cal.dat')
     np.savetxt(caldat, np.transpose([lam, ical]), fmt='%8.3f %8.5f')
     logging.info(f'spectrum {caldat} saved')
-    caltext += f'polynom degree: {deg}\npolynom for fit lambda c: {c}\n'
-    caltext += f'rms_x = {rms_x:8.4f}\nspectrum {caldat} saved\n'
     # for compatibility save *.dat with linear spacing
-    lmin = np.int(np.min(lam)) + 1
-    lmax = np.int(np.max(lam)) - 1
-    dell = int(5 * c[deg - 1]) / 10
-    # wavelength spacing of interpolated linear array, about double of original
-    llin = np.arange(lmin, lmax, dell)
-    y2 = interpolate.interp1d(lam, ical, kind='quadratic')(llin)
-    # cal2dat = str(Path(rawspec).with_suffix('')) + 'cal2.dat'
+    llin = linear_wavelength_grid(lam, c[deg - 1])
+    lmin = int(llin[0])
+    lmax = int(np.max(lam)) - 1
+    if rebin == 'flux':
+        y2 = rebin_flux(lam, ical, llin)
+    else:
+        y2 = resample_spectrum(lam, ical, llin, kind=rebin)
     cal2dat = change_extension(rawspec, 'cal2.dat')
     np.savetxt(cal2dat, np.transpose([llin, y2]), fmt='%8.3f %8.5f')
-    return caldat, cal2dat, lmin, lmax, caltext
+    return caldat, cal2dat, lmin, lmax
 
 
+# -------------------------------------------------------------------
+
+def linear_wavelength_grid(lam, disp):
+    """
+    linear wavelength grid inside the range of lam used for cal2.dat
+    :param lam: wavelengths of pixels
+    :param disp: linear coefficient of wavelength polynom [nm/pixel]
+    :return: grid from int(min) + 1 to int(max) - 1 with spacing about half the dispersion
+    """
+    lmin = int(np.min(lam)) + 1
+    lmax = int(np.max(lam)) - 1
+    dell = int(5 * disp) / 10
+    # wavelength spacing of interpolated linear array, about double of original
+    return np.arange(lmin, lmax, dell)
+
+
+# -------------------------------------------------------------------
+
+def _bin_edges(x):
+    """
+    edges of bins centred on the points x, halfway between neighbouring points
+    """
+    return np.concatenate([[1.5 * x[0] - 0.5 * x[1]], 0.5 * (x[:-1] + x[1:]), [1.5 * x[-1] - 0.5 * x[-2]]])
+
+
+# -------------------------------------------------------------------
+
+def rebin_flux(lam, spectra, llin):
+    """
+    flux conserving rebinning of spectra from the pixel wavelengths lam to the grid llin
+    the intensity is integrated over the pixel bins (cumulative sum), interpolated at the
+    edges of the new bins and differenced, cost is O(N) per spectrum
+    :param lam: wavelengths of pixels, monotonic
+    :param spectra: intensities, 1-D or 2-D with one spectrum per row (e.g. spectral cube)
+    :param llin: new wavelength grid, monotonic increasing
+    :return: mean intensity in each new bin, 1-D or 2-D with len(llin) columns, 0 outside of lam
+    """
+    lam = np.asarray(lam, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    if lam[0] > lam[-1]:
+        lam = lam[::-1]
+        spectra = spectra[..., ::-1]
+    e = _bin_edges(lam)
+    ed = np.clip(_bin_edges(llin), e[0], e[-1])
+    cum = np.cumsum(spectra * np.diff(e), axis=-1)
+    cum = np.concatenate([np.zeros(spectra.shape[:-1] + (1,)), cum], axis=-1)
+    i = np.clip(np.searchsorted(e, ed) - 1, 0, len(e) - 2)
+    w = (ed - e[i]) / (e[i + 1] - e[i])
+    cumd = cum[..., i] * (1 - w) + cum[..., i + 1] * w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rebinned = np.diff(cumd, axis=-1) / np.diff(ed)
+    return np.where((llin >= lam[0]) & (llin <= lam[-1]), rebinned, 0)
+
+
+# -------------------------------------------------------------------
+
+def calibrate_spectral_cube(cube_file, solution, rebin='flux', response=None):
+    """
+    resamples a spectral cube (see save_spectral_cube) onto the linear wavelength grid of cal2.dat,
+    all spectra of the cube are rebinned at once
+    output: cube_file with extension cal.fit, wavelength of column n: CRVAL1 + (n + 1 - CRPIX1) * CDELT1,
+    the table of light curves is copied
+    :param cube_file: spectral cube, e.g. out/r_add30_cube.fit
+    :param solution: dictionary, see wavelength_solution, or filename of saved solution
+    :param rebin: 'flux' (default) or kind of resample_spectrum
+    :param response: instrument response (lresp, resp), see build_response, None: no correction
+    :return: filename of calibrated cube
+    """
+    if isinstance(solution, str):
+        solution = read_wavelength_solution(solution)
+    c = solution['c']
+    cube, header = get_fits_image(cube_file)
+    lam = np.polyval(c, np.arange(cube.shape[1]))
+    llin = linear_wavelength_grid(lam, c[solution['deg'] - 1])
+    if rebin == 'flux':
+        cal = rebin_flux(lam, cube, llin)
+    else:
+        cal = resample_spectrum(lam, cube, llin, kind=rebin)
+    if response is not None:
+        cal = apply_response(llin, cal, response)
+    cube_dict = {key: header[key] for key in header if key not in
+                 ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'COMMENT', 'HISTORY', '')}
+    cube_dict['COMMENT'] = ''
+    cube_dict.update({'CRVAL1': float(llin[0]), 'CDELT1': float(llin[1] - llin[0]), 'CRPIX1': 1,
+                      'CTYPE1': 'WAVE', 'CUNIT1': 'nm'})
+    cal_file = change_extension(cube_file, 'cal.fit')
+    write_fits_image(cal.astype(np.float32), cal_file, cube_dict, dist=False)
+    with fits.open(change_extension(cube_file, '.fit')) as hdul_in:
+        if 'LIGHTCURVES' in hdul_in:
+            with fits.open(cal_file, mode='append') as hdul:
+                hdul.append(hdul_in['LIGHTCURVES'].copy())
+    logging.info(f'spectral cube {cal_file} saved')
+    return cal_file
+
+
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=16)
+def _resampling_matrix(src_bytes, dst_bytes, kind):
+    """
+    builds the sparse resampling matrix for a pair of grids, see resampling_matrix
+    the grids are passed as bytes, so that the matrix is cached for each pair of grids
+    """
+    src = np.frombuffer(src_bytes)
+    dst = np.frombuffer(dst_bytes)
+    order = np.argsort(src, kind='stable')  # decreasing wavelengths are allowed
+    s = src[order]
+    n = len(s)
+    rows = np.arange(len(dst))
+    if kind == 'linear':
+        i = np.clip(np.searchsorted(s, dst) - 1, 0, n - 2)
+        w = (dst - s[i]) / (s[i + 1] - s[i])
+        r = np.concatenate([rows, rows])
+        c = np.concatenate([i, i + 1])
+        v = np.concatenate([1 - w, w])
+    elif kind == 'quadratic':
+        # Lagrange parabola through the nearest source point and its neighbours
+        i = np.clip(np.searchsorted(s, dst), 1, n - 1)
+        i = np.clip(np.where(dst - s[i - 1] < s[i] - dst, i - 1, i), 1, n - 2)
+        x0, x1, x2 = s[i - 1], s[i], s[i + 1]
+        r = np.concatenate([rows, rows, rows])
+        c = np.concatenate([i - 1, i, i + 1])
+        v = np.concatenate([(dst - x1) * (dst - x2) / ((x0 - x1) * (x0 - x2)),
+                            (dst - x0) * (dst - x2) / ((x1 - x0) * (x1 - x2)),
+                            (dst - x0) * (dst - x1) / ((x2 - x0) * (x2 - x1))])
+    elif kind == 'flux':
+        # fraction of each source bin covered by the target bin, see rebin_flux for the O(N) version
+        e = _bin_edges(s)
+        ed = _bin_edges(dst)
+        i0 = np.clip(np.searchsorted(e, ed[:-1], side='right') - 1, 0, n - 1)
+        i1 = np.clip(np.searchsorted(e, ed[1:], side='left') - 1, 0, n - 1)
+        counts = np.maximum(i1 - i0 + 1, 1)
+        r = np.repeat(rows, counts)
+        c = np.repeat(i0, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        c = np.minimum(c, n - 1)
+        v = np.clip(np.minimum(e[c + 1], ed[r + 1]) - np.maximum(e[c], ed[r]), 0, None) / (ed[r + 1] - ed[r])
+    else:
+        raise ValueError(f'unknown resampling kind {kind}')
+    v = np.where((dst[r] >= s[0]) & (dst[r] <= s[-1]), v, 0)  # no extrapolation
+    return sparse.csr_matrix((v, (r, order[c])), shape=(len(dst), n))
+
+
+# -------------------------------------------------------------------
+
+def resampling_matrix(src, dst, kind='linear'):
+    """
+    returns the sparse matrix which resamples spectra from grid src onto grid dst
+    the interpolation weights are computed once for each pair of grids and kind
+    :param src: source grid, e.g. wavelengths of calibrated pixels, monotonic
+    :param dst: target grid, e.g. linear wavelength grid
+    :param kind: 'linear', 'quadratic' (3-point Lagrange) or 'flux' (mean over target bin,
+                 conserves the integrated flux)
+    :return: scipy.sparse csr matrix with shape (len(dst), len(src)), zero rows outside src
+    """
+    return _resampling_matrix(np.ascontiguousarray(src, dtype=float).tobytes(),
+                              np.ascontiguousarray(dst, dtype=float).tobytes(), kind)
+
+
+# -------------------------------------------------------------------
+
+def resample_spectrum(src, spectra, dst, kind='linear'):
+    """
+    resamples a spectrum or a stack of spectra with one sparse matrix product
+    :param src: source grid
+    :param spectra: intensities, 1-D or 2-D with one spectrum per row
+    :param dst: target grid
+    :param kind: see resampling_matrix
+    :return: resampled spectra, 1-D or 2-D with len(dst) columns
+    """
+    m = resampling_matrix(src, dst, kind)
+    return (m @ np.asarray(spectra, dtype=float).T).T
+
+
+# -------------------------------------------------------------------
+
+def response_file(fits_dict, folder=''):
+    """
+    filename of the instrument response, one response is stored for each
+    combination of INSTRUME and TELESCOP (camera and lens/grating)
+    :param fits_dict: content of fits-header
+    :param folder: directory of response files
+    :return: filename, e.g. response_Watec_f0.8-600.dat
+    """
+    key = f"{fits_dict.get('INSTRUME', '')}_{fits_dict.get('TELESCOP', '')}"
+    key = re.sub(r'[^\w.+-]', '-', key.strip())
+    return path.join(folder, f'response_{key}.dat')
+
+
+# -------------------------------------------------------------------
+
+def build_response(spec_file, reference=3000.0, smooth=10.0, rmin=0.05):
+    """
+    builds a smoothed instrument response from a calibrated spectrum of a reference source
+    the ratio observed / reference is median filtered (removes spectral lines), smoothed
+    with a gaussian and normalized to a maximum of 1
+    :param spec_file: calibrated spectrum of the reference, e.g. lampcal2.dat
+    :param reference: filename of the true reference spectrum (wavelength [nm], flux) e.g. from a star
+                      catalogue, or temperature [K] of a black body (lamp)
+    :param smooth: width [nm] of smoothing
+    :param rmin: response values below rmin are set to 0
+    :return: lresp, resp: wavelength and response for positive wavelengths (first order)
+    """
+    lam, ispec = load_spectrum(spec_file)
+    order = np.argsort(lam)
+    lam = lam[order]
+    ispec = ispec[order]
+    valid = lam > 0
+    lam = lam[valid]
+    ispec = ispec[valid]
+    if isinstance(reference, str):
+        lref, iref = np.loadtxt(reference, unpack=True, ndmin=2)
+        iref = np.interp(lam, lref, iref, left=0, right=0)
+    else:
+        # Planck function, hc/k = 1.4388e7 nm K
+        with np.errstate(over='ignore'):
+            iref = lam ** -5 / np.expm1(1.4388e7 / (lam * float(reference)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(iref > 0, ispec / iref, 0)
+    dl = np.median(np.diff(lam))
+    size = max(3, int(2 * smooth / dl) | 1)
+    resp = ndimage.gaussian_filter1d(ndimage.median_filter(ratio, size=size, mode='nearest'),
+                                     smooth / dl / 2.3548, mode='nearest')
+    resp = resp / np.max(resp)
+    resp[resp < rmin] = 0
+    return lam, resp
+
+
+# -------------------------------------------------------------------
+
+def save_response(filename, response):
+    """
+    saves instrument response as table (wavelength, response)
+    :param filename: see response_file
+    :param response: lresp, resp, see build_response
+    :return: None
+    """
+    np.savetxt(filename, np.transpose(response), fmt='%8.3f %8.5f')
+    logging.info(f'instrument response {filename} saved')
+
+
+# -------------------------------------------------------------------
+
+def load_response(filename):
+    """
+    reads instrument response saved with save_response
+    :param filename: see response_file
+    :return: lresp, resp
+    """
+    lresp, resp = np.loadtxt(filename, unpack=True, ndmin=2)
+    return lresp, resp
+
+
+# -------------------------------------------------------------------
+
+def get_response(correct, fits_dict):
+    """
+    loads the instrument response of the actual instrument if response correction is selected
+    :param correct: if False, no correction
+    :param fits_dict: content of fits-header, INSTRUME and TELESCOP select the response
+    :return: lresp, resp or None
+    """
+    if correct:
+        resp_file = response_file(fits_dict)
+        try:
+            return load_response(resp_file)
+        except OSError:
+            sg.PopupError(f'no instrument response {resp_file} found, build response first, spectra not corrected',
+                          title='Instrument response')
+    return None
+
+
+# -------------------------------------------------------------------
+
+def apply_response(lam, spectra, response):
+    """
+    divides spectra by the instrument response, vectorized for a single spectrum or a cube
+    the response is interpolated onto lam with a cached resampling matrix, see resampling_matrix
+    outside the range of the response the spectra are not corrected,
+    where the response is 0 the spectra are set to 0
+    :param lam: wavelength grid of spectra
+    :param spectra: intensities, 1-D or 2-D with one spectrum per row
+    :param response: lresp, resp, see build_response
+    :return: corrected spectra
+    """
+    lresp, resp = response
+    lam = np.asarray(lam, dtype=float)
+    r = resample_spectrum(lresp, resp, lam, kind='linear')
+    r = np.where((lam >= np.min(lresp)) & (lam <= np.max(lresp)), r, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r > 0, np.asarray(spectra, dtype=float) / r, 0)
+
+
+# -------------------------------------------------------------------
+
+def calibrate_raw_spectra(raw_files, solution, rebin='quadratic', response=None):
+    """
+    applies a saved wavelength solution to many raw spectra, e.g. all spectra of a night
+    :param raw_files: list of uncalibrated spectra or glob pattern, e.g. 'out/r_add*.dat'
+    :param solution: dictionary, see wavelength_solution, or filename of saved solution
+    :param rebin: resampling of cal2.dat, see apply_wavelength_solution
+    :param response: instrument response (lresp, resp), see build_response, None: no correction
+    :return: list of (caldat, cal2dat) of calibrated spectra
+    """
+    if isinstance(solution, str):
+        solution = read_wavelength_solution(solution)
+    if isinstance(raw_files, str):
+        # skip calibrated spectra matching the same pattern
+        raw_files = [f for f in sorted(glob.glob(raw_files)) if not f.endswith(('cal.dat', 'cal2.dat'))]
+    calibrated = []
+    for rawspec in raw_files:
+        try:
+            caldat, cal2dat, lmin, lmax = apply_wavelength_solution(rawspec, solution, rebin=rebin,
+                                                                     response=response)
+            calibrated.append((caldat, cal2dat))
+        except Exception as e:
+            logging.info(f'{rawspec} not calibrated: {e}')
+    logging.info(f'{len(calibrated)} of {len(raw_files)} spectra calibrated')
+    return calibrated
+
+
+# np.loadtxt is implemented in C since numpy 1.23, before it is much slower than np.fromstring
+_c_loadtxt = tuple(int(v) for v in np.__version__.split('.')[:2]) >= (1, 23)
+
+
+def _parse_spectrum(filename):
+    """
+    fast parser for spectra saved with np.savetxt (2 columns, no comments),
+    other files are read with np.loadtxt
+    """
+    if not _c_loadtxt:
+        with open(filename, 'r') as f:
+            text = f.read()
+        if '#' not in text:
+            values = np.fromstring(text, dtype=float, sep=' ')
+            if len(values) and len(values) % 2 == 0 and len(values) // 2 == text.strip().count('\n') + 1:
+                return values[0::2].copy(), values[1::2].copy()
+    lcal, ical = np.loadtxt(filename, unpack=True, ndmin=2)
+    return lcal, ical
+
+
+# -------------------------------------------------------------------
+
+def load_spectrum(filename):
+    """
+    reads spectrum (.dat) with 2 columns, the result is cached in memory (the last 64 spectra)
+    and reused as long as modification time and size of the file do not change
+    the returned arrays are read only, copy them before in-place changes
+    :param filename: spectrum, e.g. r_add30cal2.dat
+    :return: lcal, ical: pixel or wavelength array, intensity array
+    """
+    key = path.abspath(filename)
+    stat = os.stat(key)
+    return _cached_spectrum(key, stat.st_mtime_ns, stat.st_size)
+
+
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=64)
+def _cached_spectrum(filename, mtime, size):
+    """
+    parses spectrum, cached for the last 64 files until modification time or size of the file change
+    """
+    lcal, ical = _parse_spectrum(filename)
+    lcal.flags.writeable = False
+    ical.flags.writeable = False
+    return lcal, ical
+
+
+# -------------------------------------------------------------------
+
+def load_spectra(files, workers=4):
+    """
+    reads several spectra in parallel threads, see load_spectrum
+    :param files: list of spectra
+    :param workers: number of threads
+    :return: list of (lcal, ical) in the order of files
+    """
+    if workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(load_spectrum, files))
+    return [load_spectrum(f) for f in files]
+
+
+# -------------------------------------------------------------------
+
 def change_extension(file_name, extension=''):
     """
     if no extension is specified, it is stripped from the filename
@@ -1462,6 +3284,10 @@ def add_images(graph_size, contrast=1, average=True):
     window = sg.Window('Add registered images', [[sg.Input('', key='add_images', size=(80, 1)),
                                                   sg.Button('Load Files')],
                                                  [sg.Text('Number Images:'), sg.Input('0', size=(8, 1), key='nim'),
+                                                  sg.Text('Method:'),
+                                                  sg.Combo(['mean', 'median', 'clip'], default_value='mean',
+                                                           size=(8, 1), key='combine', readonly=True,
+                                                           tooltip='clip: sigma clipped mean'),
                                                   sg.Button('Darker'), sg.Button('Brighter')],
                                                  [graph_element], [sg.Button('Save'), sg.Button('Cancel')]])
     while True:  # Event Loop
@@ -1470,20 +3296,16 @@ def add_images(graph_size, contrast=1, average=True):
             files = sg.PopupGetFile('Add images', multiple_files=True, save_as=False,
                                     file_types=(('Image Files', '*.fit'), ('ALL Files', '*.*'),), no_window=True)
             if files:
-                sum_image = []
-                number_images = 0
                 short_files = path.dirname(files[0])
                 try:
                     for file in files:
                         short_files += ' ' + path.basename(file)
-                        image, header = get_fits_image(change_extension(file, ''))
-                        if sum_image == []:
-                            sum_image = image
-                        else:
-                            sum_image += image
-                        number_images += 1
-                    if average and number_images:
-                        sum_image /= number_images
+                    files = [change_extension(file, '.fit') for file in files]
+                    number_images = len(files)
+                    sum_image = combine_images(files, method=values['combine'])
+                    if not average:
+                        sum_image *= number_images
+                    header = fits.getheader(files[-1])
                     get_fits_keys(header, fits_dict, res_dict)
                     fits_dict['M_STARTI'] = '0'  # set value for special addition
                     dist = False
@@ -1587,6 +3409,21 @@ def get_img_filename(f, opt_dict, contr=1, tmp_image=False, resize=True, get_arr
         return bio.getvalue(), im_scale
 
 
+def _image_to_png(image, contr=1):
+    """
+    converts image array to PNG data for display, scaled as in get_img_filename
+    :param image: b/w or color image, rows from bottom to top
+    :param contr: image brightness
+    :return: byte-array from buffer
+    """
+    if np.max(image) > 0.0:
+        image = image / np.max(image)
+    ima = np.flipud(np.uint8(255 * np.clip(image * contr, 0, 1)))
+    bio = io.BytesIO()
+    Image.fromarray(ima).save(bio, format="PNG")
+    return bio.getvalue()
+
+
 def get_img_data(data, resize=None):
     """Generate PIL.Image data using PIL
     not used, does not seem to work